@@ -32,6 +32,8 @@ import pandas as pd
 import re
 # For formatting date objects
 from datetime import datetime
+# For copying Profile_Filters objects
+import copy
 # For reading netcdf files
 import xarray as xr
 # Import the Thermodynamic Equation of Seawater 2010 (TEOS-10) from GSW
@@ -49,6 +51,8 @@ import hdbscan
 from geopy.distance import geodesic
 # For calculating Orthogonal Distance Regression for Total Least Squares
 from orthoregress import orthoregress
+# For handling both padded and ragged netcdfs
+import data_helper_functions as dhf
 
 """
 To install Cartopy and its dependencies, follow:
@@ -217,7 +221,8 @@ class Data_Filters:
     geo_extent          None to keep all profiles regardless of geographic region
                         or 'CS' for Chukchi Sea, 'SBS' for Southern Beaufort Sea,
                         'CB' for Canada Basin, 'MB' for Makarov Basin, 'EB' for
-                        Eurasian Basin, or 'BS' for Barents Sea
+                        Eurasian Basin, or 'BS' for Barents Sea, or a list of
+                        those to keep profiles in any of them (ex: ['MB','EB'])
     date_range          ['start_date','end_date'] where the dates are strings in
                         the format 'YYYY/MM/DD' or None to keep all profiles
     """
@@ -240,13 +245,69 @@ class Data_Set:
                     where the keys are the netcdf filenames without the extension
                     and the values are lists of profiles to include or 'all'
     data_filters    A custom Data_Filters object that contains the filters to apply
+    lazy            True/False whether to open the netcdfs lazily, so that only
+                    the per-profile variables needed to apply the data filters
+                    are read at first. The other variables are only read once
+                    the Analysis_Groups using this Data_Set need them, and then
+                    only the ones they need. False to load every variable up
+                    front
+    chunks          The chunks to read lazily opened netcdfs in, ex: 'auto' or
+                    {'Time':500}
     """
-    def __init__(self, sources_dict, data_filters):
+    def __init__(self, sources_dict, data_filters, lazy=True, chunks='auto'):
         # Load just the relevant profiles into the xarrays
         self.sources_dict = sources_dict
         self.data_filters = data_filters
-        xarrs, self.var_attr_dicts = list_xarrays(sources_dict)
+        xarrs, self.var_attr_dicts = list_xarrays(sources_dict, lazy, chunks)
         self.arr_of_ds = apply_data_filters(xarrs, data_filters)
+        # Keep the datasets before they're trimmed to the profile filters
+        self.full_arr_of_ds = list(self.arr_of_ds)
+        # The variables which the Analysis_Groups using this Data_Set need
+        self.vars_requested = set()
+        # The profile filters of the Analysis_Groups using this Data_Set, and
+        #   those that the datasets were last trimmed to
+        self.pfs_requested = []
+        self.pfs_trimmed_to = []
+
+    def request_vars(self, vars_to_keep, profile_filters=None):
+        """
+        Adds to the set of variables to read for the Analysis_Groups using
+        this Data_Set
+
+        vars_to_keep    A list of variables needed by an Analysis_Group
+        profile_filters A custom Profile_Filters object of the ranges needed by
+                            an Analysis_Group, or None if it needs whole profiles
+        """
+        self.vars_requested.update(vars_to_keep)
+        self.pfs_requested.append(profile_filters)
+
+    def load_requested_vars(self):
+        """
+        Reads in all the requested variables that haven't been read yet, for
+        just the profiles that passed the data filters, all at once. Only the
+        profiles and vertical levels that could pass the ranges of the profile
+        filters are read
+        """
+        # Trim the datasets again if a new Analysis_Group has been added
+        if self.pfs_requested != self.pfs_trimmed_to:
+            for i in range(len(self.arr_of_ds)):
+                ds = trim_to_profile_filters(self.full_arr_of_ds[i], self.pfs_requested)
+                # Keep any global attributes that were changed since trimming
+                ds.attrs = self.arr_of_ds[i].attrs
+                self.arr_of_ds[i] = ds
+            self.pfs_trimmed_to = list(self.pfs_requested)
+        for i in range(len(self.arr_of_ds)):
+            ds = self.arr_of_ds[i]
+            # Find the variables which haven't been read from disk yet
+            vars_to_load = [var for var in self.vars_requested if var in ds.data_vars and not isinstance(ds[var].data, np.ndarray)]
+            if len(vars_to_load) > 0:
+                # Computing the variables together reads each chunk once
+                ds_loaded = ds[vars_to_load].load()
+                for var in vars_to_load:
+                    ds[var] = ds_loaded[var]
+                #
+            #
+        #
 
 ################################################################################
 
@@ -264,7 +325,10 @@ class Profile_Filters:
                             [var, Delta_var] where you specify the variable then the value
                             of the spacing to regrid that value to
     m_avg_win           The value in dbar of the moving average window to take for ma_ variables
-                            This is multiplied by 4 to get the number of rows to average
+                            This is divided by the vertical resolution to get the number of rows to average
+                            If stored along `ell` by `take_moving_average.py`, those are used instead
+                            If a list of values, the dataframes have a copy of the data for
+                            each window, with the window as the first level of the index, `ell`
     """
     def __init__(self, p_range=None, d_range=None, iT_range=None, CT_range=None, PT_range=None, SP_range=None, SA_range=None, subsample=False, regrid_TS=None, m_avg_win=None):
         self.p_range = p_range
@@ -401,14 +465,33 @@ class Analysis_Group:
         self.plt_params = get_axis_labels(plt_params, data_set.var_attr_dicts)
         self.plot_title = plot_title
         self.vars_to_keep = find_vars_to_keep(plt_params, profile_filters, self.vars_available)
-        # Load just the relevant profiles into the xarrays
-        self.data_frames = apply_profile_filters(data_set.arr_of_ds, self.vars_to_keep, profile_filters, plt_params)
+        # Let the data set know which variables to read for this group
+        #   Only plots by vertical level filter the profiles to the given ranges
+        if plt_params.plot_scale == 'by_vert':
+            data_set.request_vars(self.vars_to_keep, profile_filters)
+        else:
+            data_set.request_vars(self.vars_to_keep)
+        # The dataframes are made when they're first needed, so that the data set
+        #   can read the variables needed by all of its groups at once
+        self._data_frames = None
+
+    @property
+    def data_frames(self):
+        # Load just the relevant profiles into dataframes
+        if isinstance(self._data_frames, type(None)):
+            self.data_set.load_requested_vars()
+            self._data_frames = apply_profile_filters(self.data_set.arr_of_ds, self.vars_to_keep, self.profile_filters, self.plt_params)
+        return self._data_frames
+
+    @data_frames.setter
+    def data_frames(self, data_frames):
+        self._data_frames = data_frames
 
 ################################################################################
 # Define class functions #######################################################
 ################################################################################
 
-def list_xarrays(sources_dict):
+def list_xarrays(sources_dict, lazy=False, chunks='auto'):
     """
     Returns a list of xarrays, one for each data source as specified by the
     input dictionary
@@ -417,12 +500,20 @@ def list_xarrays(sources_dict):
                     {'ITP_1':[13,22,32],'ITP_2':'all'}
                     where the keys are the netcdf filenames without the extension
                     and the values are lists of profiles to include or 'all'
+    lazy            True/False whether to open the netcdfs lazily with dask
+                    instead of loading them into memory. Only the per-profile
+                    variables used to select profiles get read right away
+    chunks          The chunks to read lazily opened netcdfs in, ex: 'auto' or
+                    {'Time':500}
     """
     # Make an empty list
     xarrays = []
     var_attr_dicts = []
     for source in sources_dict.keys():
-        ds = xr.load_dataset('netcdfs/'+source+'.nc')
+        # Load from the netcdf, or the zarr store if there's no netcdf
+        #   Each file is only read once per session, no matter how many
+        #   Data_Set objects use it
+        ds = dhf.load_dataset_cached(dhf.find_dataset_path(source), lazy, chunks)
         # Build the dictionary of netcdf attributes, variables, units, etc.
         var_attrs = {}
         for this_var in list(ds.keys()):
@@ -433,13 +524,11 @@ def list_xarrays(sources_dict):
         # Check whether to only take certain profiles
         pf_list = sources_dict[source]
         if isinstance(pf_list, list):
-            # Start a blank list for all the profile-specific xarrays
-            temp_list = []
-            for pf in pf_list:
-                temp_list.append(ds.where(ds.prof_no==pf, drop=True).squeeze())
-            # Concatonate all those xarrays together
-            ds1 = xr.concat(temp_list, 'Time')
-            xarrays.append(ds1)
+            # Find the index of each profile, in the order given
+            pf_idx = dhf.find_profile_index(ds, pf_list)
+            # Take just those profiles all at once, which keeps the dtypes, along
+            #   with their observations along `obs` for ragged datasets
+            xarrays.append(dhf.select_profiles(ds, pf_idx))
         # Take all profiles
         elif pf_list=='all':
             xarrays.append(ds)
@@ -462,36 +551,112 @@ def apply_data_filters(xarrays, data_filters):
     # Make an empty list
     output_arrs = []
     for ds in xarrays:
-        ## Filters on a per-profile basis
-        ##      I turned off squeezing because it drops the `Time` dimension if
-        ##      you only pass in one profile per dataset
-        #   Filter based on the black list
-        if data_filters.keep_black_list == False:
-            ds = ds.where(ds.BL_yn==False, drop=True)#.squeeze()
-        #   Filter based on the cast direction
-        if data_filters.cast_direction == 'up':
-            ds = ds.where(ds.up_cast==True, drop=True)#.squeeze()
-        elif data_filters.cast_direction == 'down':
-            ds = ds.where(ds.up_cast==False, drop=True)#.squeeze()
-        #   Filter based on the geographical region
-        if data_filters.geo_extent == 'CB':
-            ds = ds.where(ds.region=='CB', drop=True)#.squeeze()
-        #   Filter based on the date range
-        if not isinstance(data_filters.date_range, type(None)):
-            # Allow for date ranges that do or don't specify the time
-            try:
-                start_date_range = datetime.strptime(data_filters.date_range[0], r'%Y/%m/%d %H:%M:%S')
-            except:
-                start_date_range = datetime.strptime(data_filters.date_range[0], r'%Y/%m/%d')
-            try:
-                end_date_range   = datetime.strptime(data_filters.date_range[1], r'%Y/%m/%d %H:%M:%S')
-            except:
-                end_date_range   = datetime.strptime(data_filters.date_range[1], r'%Y/%m/%d')
-            ds = ds.sel(Time=slice(start_date_range, end_date_range))
-        #
+        # Combine all the filters into one mask along `Time`
+        pf_mask = find_data_filter_mask(ds, data_filters)
+        # Only select profiles if some need to be removed, otherwise the dataset
+        #   is passed along as is, without copying any of the data
+        if not pf_mask.all():
+            # Selects the profiles all at once, keeping the dtypes, along with
+            #   their observations along `obs` for ragged datasets
+            ds = dhf.select_profiles(ds, np.flatnonzero(pf_mask))
         output_arrs.append(ds)
     return output_arrs
 
+def find_data_filter_mask(ds, data_filters):
+    """
+    Returns a boolean array along `Time` of which profiles of the dataset pass
+    all the filters, found from just the per-profile variables
+
+    ds              An xarray dataset
+    data_filters    A custom Data_Filters object that contains the filters to apply
+    """
+    # Start by keeping all the profiles
+    pf_mask = np.full(ds.sizes['Time'], True)
+    #   Filter based on the black list
+    if data_filters.keep_black_list == False:
+        pf_mask &= ds['BL_yn'].values == False
+    #   Filter based on the cast direction
+    if data_filters.cast_direction == 'up':
+        pf_mask &= ds['up_cast'].values == True
+    elif data_filters.cast_direction == 'down':
+        pf_mask &= ds['up_cast'].values == False
+    #   Filter based on the geographical region
+    if not isinstance(data_filters.geo_extent, type(None)):
+        pf_mask &= dhf.region_mask(ds['region'].values, data_filters.geo_extent)
+    #   Filter based on the date range
+    if not isinstance(data_filters.date_range, type(None)):
+        # Allow for date ranges that do or don't specify the time
+        try:
+            start_date_range = datetime.strptime(data_filters.date_range[0], r'%Y/%m/%d %H:%M:%S')
+        except:
+            start_date_range = datetime.strptime(data_filters.date_range[0], r'%Y/%m/%d')
+        try:
+            end_date_range   = datetime.strptime(data_filters.date_range[1], r'%Y/%m/%d %H:%M:%S')
+        except:
+            end_date_range   = datetime.strptime(data_filters.date_range[1], r'%Y/%m/%d')
+        # Inclusive on both ends, like selecting a slice of `Time`
+        pf_mask &= (ds['Time'].values >= np.datetime64(start_date_range)) & (ds['Time'].values <= np.datetime64(end_date_range))
+    #
+    return pf_mask
+
+def trim_to_profile_filters(ds, list_of_pfs):
+    """
+    Returns the given dataset with just the profiles and vertical levels that
+    could pass the ranges in at least one of the given profile filters, so that
+    the data outside of them are never read. The profiles are checked against
+    the per-profile minimums and maximums stored in the dataset, and the levels
+    against the pressure and depth ranges. These are a superset of what
+    `filter_profile_ranges` keeps, which still needs to be applied afterwards
+
+    ds              An xarray dataset
+    list_of_pfs     A list of custom Profile_Filters objects, or None for any
+                        Analysis_Group that needs the whole profiles
+    """
+    # Don't trim anything if any group needs the whole profiles
+    if len(list_of_pfs) == 0 or any(isinstance(pfs, type(None)) for pfs in list_of_pfs):
+        return ds
+    # Start by removing all the profiles, then add back those that could pass
+    #   the ranges of any of the profile filters
+    pf_mask = np.full(ds.sizes['Time'], False)
+    for pfs in list_of_pfs:
+        this_mask = np.full(ds.sizes['Time'], True)
+        for var in dhf.zone_vars:
+            var_range = getattr(pfs, dict(press='p_range', depth='d_range').get(var, var+'_range'))
+            if not isinstance(var_range, type(None)):
+                this_mask &= dhf.zone_mask(ds, var, var_range)
+            #
+        pf_mask |= this_mask
+    if not pf_mask.all():
+        ds = dhf.select_profiles(ds, np.flatnonzero(pf_mask))
+    # Only trim the vertical levels if all the profile filters have a pressure
+    #   or depth range
+    if any(isinstance(pfs.p_range, type(None)) and isinstance(pfs.d_range, type(None)) for pfs in list_of_pfs):
+        return ds
+    # Find the levels within the ranges of any of the profile filters, with
+    #   room on either side for the moving average window
+    level_mask = False
+    for pfs in list_of_pfs:
+        if isinstance(pfs.m_avg_win, type(None)):
+            pad = 0
+        else:
+            pad = np.max(pfs.m_avg_win)
+        this_mask = True
+        if not isinstance(pfs.p_range, type(None)):
+            # Gridded datasets have the same pressure at each level
+            if dhf.is_gridded(ds):
+                press = ds['press_level'].values
+            else:
+                press = ds['press'].values
+            this_mask = this_mask & (press > min(pfs.p_range)-pad) & (press < max(pfs.p_range)+pad)
+        if not isinstance(pfs.d_range, type(None)):
+            depth = ds['depth'].values
+            this_mask = this_mask & (depth > min(pfs.d_range)-pad) & (depth < max(pfs.d_range)+pad)
+        level_mask = level_mask | this_mask
+    # The vertical variables are (Time, press_level) for gridded datasets
+    if dhf.is_gridded(ds) and np.ndim(level_mask) == 1:
+        level_mask = np.broadcast_to(level_mask, ds['press'].shape)
+    return dhf.select_levels(ds, level_mask)
+
 ################################################################################
 
 def find_vars_to_keep(pp, profile_filters, vars_available):
@@ -670,22 +835,47 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
     # What's the plot scale?
     if plot_scale == 'by_vert':
         for ds in arr_of_ds:
+            # Use the moving averages stored in the dataset for this window, if
+            #   there are any, otherwise they are taken below
+            ds, m_avg_win = select_m_avg_win(ds, profile_filters.m_avg_win)
             # Find extra variables, if applicable
             ds = calc_extra_vars(ds, vars_to_keep)
-            # Convert to a pandas data frame
-            df = ds[vars_to_keep].to_dataframe()
+            # Convert to a pandas data frame, leaving out the padding
+            #   The columns of ragged datasets aren't copied, so they are
+            #   replaced below rather than modified in place
+            if 'ell' in ds.dims:
+                # Stack the dataframes for each window, as done below when the
+                #   moving averages for a list of windows are taken
+                ell_dfs = []
+                for i in range(ds.sizes['ell']):
+                    ell_dfs.append(dhf.profiles_to_dataframe(ds.isel(ell=i), vars_to_keep, drop_padding=True, copy=False))
+                df = pd.concat(ell_dfs, keys=list(profile_filters.m_avg_win), names=['ell'])
+            else:
+                df = dhf.profiles_to_dataframe(ds, vars_to_keep, drop_padding=True, copy=False)
             # Find average variables, if applicable
             # df = calc_avg_vars(df, vars_to_keep)
             # Add a notes column
             df['notes'] = ''
             #   If the m_avg_win is not None, take the moving average of the data
-            if not isinstance(profile_filters.m_avg_win, type(None)):
-                df = take_m_avg(df, profile_filters.m_avg_win, vars_to_keep)
+            if not isinstance(m_avg_win, type(None)):
+                if np.ndim(m_avg_win) == 0:
+                    df = take_m_avg(df, m_avg_win, vars_to_keep, res=dhf.get_vert_res(ds))
+                else:
+                    # Take the moving averages for all the windows at once, then
+                    #   stack a copy of the dataframe for each window, with the
+                    #   window added as the first level of the index, `ell`
+                    ds_m_avgs = take_m_avgs(df, m_avg_win, vars_to_keep, res=dhf.get_vert_res(ds))
+                    ell_dfs = []
+                    for i in range(len(m_avg_win)):
+                        ell_dfs.append(df.assign(**{var:ds_m_avgs[var].values[i] for var in ds_m_avgs.data_vars}))
+                    df = pd.concat(ell_dfs, keys=list(m_avg_win), names=['ell'])
+                #
             #   True/False, apply the subsample mask to the profiles
             if profile_filters.subsample:
-                # `ss_mask` is null for the points that should be masked out
-                # so apply mask to all the variables that were kept
-                df.loc[df['ss_mask'].isnull(), vars_to_keep] = None
+                # `ss_mask` is True (or 1 in older netcdfs) for the points to keep,
+                # and False or null for those that should be masked out, so
+                # apply mask to all the variables that were kept
+                df[vars_to_keep] = df[vars_to_keep].where(df['ss_mask'] == 1)
                 # Set a new column so the ss_scheme can be found later for the title
                 df['ss_scheme'] = ds.attrs['Sub-sample scheme']
             # Remove rows where the plot variables are null
@@ -723,24 +913,21 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
             # Check whether or not to take first differences
             first_dfs = pp.first_dfs
             if any(first_dfs):
-                # Get list of profiles
-                pfs = np.unique(np.array(df['prof_no']))
                 # Take first differences in x variables
                 if first_dfs[0]:
-                    # Loop across each profile
-                    new_dfs = []
-                    for pf in pfs:
-                        # Find the data for just that profile
-                        data_pf = df[df['prof_no'] == pf]
-                        # Loop across all x variables
-                        for var in pp.x_vars:
-                            # Replace the plot variable names
-                            dvar = 'd_'+var
-                            # Make the given variable into first differences
-                            data_pf[dvar] = data_pf[var].diff()
-                        new_dfs.append(data_pf)
-                    # Re-form the dataframe
-                    df = pd.concat(new_dfs)
+                    # Group the rows by profile, and by moving average window if
+                    #   there are several, so no differences are taken across them
+                    if 'ell' in df.index.names:
+                        pf_groups = df.groupby(['ell', 'prof_no'])
+                    else:
+                        pf_groups = df.groupby('prof_no')
+                    # Loop across all x variables
+                    for var in pp.x_vars:
+                        # Replace the plot variable names
+                        dvar = 'd_'+var
+                        # Make the given variable into first differences, taken
+                        #   separately within each profile
+                        df[dvar] = pf_groups[var].diff()
                     # Replace the plot variable names
                     for i in range(len(pp.x_vars)):
                         dvar = 'd_'+pp.x_vars[i]
@@ -750,20 +937,19 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
                     #
                 # Take finite differences in y variables
                 if len(first_dfs)==2 and first_dfs[1]:
-                    # Loop across each profile
-                    new_dfs = []
-                    for pf in pfs:
-                        # Find the data for just that profile
-                        data_pf = df[df['prof_no'] == pf]
-                        # Loop across all y variables
-                        for var in pp.y_vars:
-                            # Replace the plot variable names
-                            dvar = 'd_'+var
-                            # Make the given variable into first differences
-                            data_pf[dvar] = data_pf[var].diff()
-                        new_dfs.append(data_pf)
-                    # Re-form the dataframe
-                    df = pd.concat(new_dfs)
+                    # Group the rows by profile, and by moving average window if
+                    #   there are several, so no differences are taken across them
+                    if 'ell' in df.index.names:
+                        pf_groups = df.groupby(['ell', 'prof_no'])
+                    else:
+                        pf_groups = df.groupby('prof_no')
+                    # Loop across all y variables
+                    for var in pp.y_vars:
+                        # Replace the plot variable names
+                        dvar = 'd_'+var
+                        # Make the given variable into first differences, taken
+                        #   separately within each profile
+                        df[dvar] = pf_groups[var].diff()
                     # Repalce the plot varaible names
                     for i in range(len(pp.y_vars)):
                         dvar = 'd_'+pp.y_vars[i]
@@ -776,26 +962,23 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
             # Check whether or not to take finite differences
             finit_dfs = pp.finit_dfs
             if any(finit_dfs):
-                # Get list of profiles
-                pfs = np.unique(np.array(df['prof_no']))
                 # Take finite differences in x variables
                 if finit_dfs[0]:
                     # Find y variable
                     y_var = pp.y_vars[0]
-                    # Loop across each profile
-                    new_dfs = []
-                    for pf in pfs:
-                        # Find the data for just that profile
-                        data_pf = df[df['prof_no'] == pf]
-                        # Loop across all x variables
-                        for var in pp.x_vars:
-                            # Replace the plot variable names
-                            dvar = 'd_'+var
-                            # Make the given variable into finite difference
-                            data_pf[dvar] = data_pf[var].diff() / data_pf[y_var].diff()
-                        new_dfs.append(data_pf)
-                    # Re-form the dataframe
-                    df = pd.concat(new_dfs)
+                    # Group the rows by profile, and by moving average window if
+                    #   there are several, so no differences are taken across them
+                    if 'ell' in df.index.names:
+                        pf_groups = df.groupby(['ell', 'prof_no'])
+                    else:
+                        pf_groups = df.groupby('prof_no')
+                    # Loop across all x variables
+                    for var in pp.x_vars:
+                        # Replace the plot variable names
+                        dvar = 'd_'+var
+                        # Make the given variable into finite difference, taken
+                        #   separately within each profile
+                        df[dvar] = pf_groups[var].diff() / pf_groups[y_var].diff()
                     # Replace the plot variable names
                     for i in range(len(pp.x_vars)):
                         dvar = 'd_'+pp.x_vars[i]
@@ -807,20 +990,19 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
                 if len(finit_dfs)==2 and finit_dfs[1]:
                     # Find x variable
                     x_var = pp.x_vars[0]
-                    # Loop across each profile
-                    new_dfs = []
-                    for pf in pfs:
-                        # Find the data for just that profile
-                        data_pf = df[df['prof_no'] == pf]
-                        # Loop across all y variables
-                        for var in pp.y_vars:
-                            # Replace the plot variable names
-                            dvar = 'd_'+var
-                            # Make the given variable into finite difference
-                            data_pf[dvar] = data_pf[var].diff() / data_pf[x_var].diff()
-                        new_dfs.append(data_pf)
-                    # Re-form the dataframe
-                    df = pd.concat(new_dfs)
+                    # Group the rows by profile, and by moving average window if
+                    #   there are several, so no differences are taken across them
+                    if 'ell' in df.index.names:
+                        pf_groups = df.groupby(['ell', 'prof_no'])
+                    else:
+                        pf_groups = df.groupby('prof_no')
+                    # Loop across all y variables
+                    for var in pp.y_vars:
+                        # Replace the plot variable names
+                        dvar = 'd_'+var
+                        # Make the given variable into finite difference, taken
+                        #   separately within each profile
+                        df[dvar] = pf_groups[var].diff() / pf_groups[x_var].diff()
                     # Repalce the plot varaible names
                     for i in range(len(pp.y_vars)):
                         dvar = 'd_'+pp.y_vars[i]
@@ -836,14 +1018,14 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
     elif plot_scale == 'by_pf':
         for ds in arr_of_ds:
             # Convert to a pandas data frame
-            df = ds[vars_to_keep].to_dataframe()
+            df = dhf.profiles_to_dataframe(ds, vars_to_keep)
             # Add expedition and instrument columns
             df['source'] = ds.Expedition
             df['instrmt'] = ds.Instrument
             ## Filters on each profile separately
             df = filter_profile_ranges(df, profile_filters, 'press', 'depth', iT_key='iT', CT_key='CT', PT_key='PT', SP_key='SP', SA_key='SA')
             # Drop dimensions, if needed
-            if 'Vertical' in df.index.names:
+            if 'Vertical' in df.index.names or 'press_level' in df.index.names:
                 # Drop duplicates along the `Time` dimension
                 #   (need to make the index `Time` a column first)
                 df.reset_index(level=['Time'], inplace=True)
@@ -866,53 +1048,97 @@ def apply_profile_filters(arr_of_ds, vars_to_keep, profile_filters, pp):
 
 ################################################################################
 
-def take_m_avg(df, m_avg_win, vars_available):
+def select_m_avg_win(ds, m_avg_win):
     """
-    Returns the same pandas dataframe, but with the filters provided applied to
-    the data within
+    Returns the given dataset with the moving averages stored along `ell` for the
+    given window selected, along with the window(s) for which the moving
+    averages still need to be taken, or None if they were all stored. Datasets
+    without moving averages stored along `ell` are returned as is
+
+    ds                  An xarray dataset
+    m_avg_win           The value in dbar of the moving average window, a list
+                            of values, or None to use the default window, the
+                            first one stored
+    """
+    if 'ell' not in ds.dims:
+        return ds, m_avg_win
+    ells = list(ds['ell'].values)
+    if isinstance(m_avg_win, type(None)):
+        return ds.isel(ell=0), None
+    elif np.ndim(m_avg_win) == 0 and m_avg_win in ells:
+        print('\tUsing the stored moving averages, m_avg_win:',m_avg_win)
+        return ds.isel(ell=ells.index(m_avg_win)), None
+    elif np.ndim(m_avg_win) == 1 and all(win in ells for win in m_avg_win):
+        print('\tUsing the stored moving averages, m_avg_win:',m_avg_win)
+        return ds.isel(ell=[ells.index(win) for win in m_avg_win]), None
+    else:
+        # The moving averages will be replaced, so just drop the `ell` dimension
+        return ds.isel(ell=0), m_avg_win
 
-    df                  A pandas dataframe
+def take_m_avg(df, m_avg_win, vars_available, res=0.25):
+    """
+    Returns the same pandas dataframe, but with the moving average and local
+    anomaly columns, ex: `ma_CT` and `la_CT`, of the variables available added.
+    The averages are taken separately within each profile, so they never mix
+    values from different profiles
+
+    df                  A pandas dataframe with the rows of each profile together
+                            and in order, with `Time` in the index
     m_avg_win           The value of the moving average window in dbar
     vars_available      A list of variables available in the dataframe
+    res                 The vertical resolution of the data in dbar
     """
     print('\tIn take_m_avg(), m_avg_win:',m_avg_win)
-    # Use the pandas `rolling` function to get the moving average
-    #   center=True makes the first and last window/2 of the profiles are masked
-    #   win_type='boxcar' uses a rectangular window shape
-    #   on='press' means it will take `press` as the index column
-    #   .mean() takes the average of the rolling
-    #   multiplying m_avg_win by 4 because the data is in 0.25 dbar increments
-    df1 = df.rolling(window=int(m_avg_win*4), center=True, win_type='boxcar', on='press').mean()
-    # Put the moving average profiles for temperature, salinity, and density into the dataset
-    for var in vars_available:
-        if var in ['iT','ma_iT','la_iT']:
-            df['ma_iT'] = df1['iT']
-            if 'la_iT' in vars_available:
-                df['la_iT'] = df['iT'] - df['ma_iT']
-        if var in ['CT','ma_CT','la_CT']:
-            df['ma_CT'] = df1['CT']
-            if 'la_CT' in vars_available:
-                df['la_CT'] = df['CT'] - df['ma_CT']
-        if var in ['PT','ma_PT','la_PT']:
-            df['ma_PT'] = df1['PT']
-            if 'la_PT' in vars_available:
-                df['la_PT'] = df['PT'] - df['ma_PT']
-        if var in ['SP','ma_SP','la_SP']:
-            df['ma_SP'] = df1['SP']
-            if 'la_SP' in vars_available:
-                df['la_SP'] = df['SP'] - df['ma_SP']
-        if var in ['SA','ma_SA','la_SA']:
-            df['ma_SA'] = df1['SA']
-            if 'la_SA' in vars_available:
-                df['la_SA'] = df['SA'] - df['ma_SA']
-        if var in ['sigma','ma_sigma','la_sigma']:
-            df['ma_sigma'] = df1['sigma']
-            if 'la_sigma' in vars_available:
-                df['la_sigma'] = df['sigma'] - df['ma_sigma']
-            #
+    ds_m_avgs = take_m_avgs(df, [m_avg_win], vars_available, res)
+    # Put the moving average profiles and the local anomalies into the dataframe
+    for var in ds_m_avgs.data_vars:
+        df[var] = ds_m_avgs[var].values[0]
+    return df
+
+def take_m_avgs(df, list_of_m_avg_wins, vars_available, res=0.25):
+    """
+    Returns an xarray dataset of the moving averages and local anomalies, ex:
+    `ma_CT` and `la_CT`, of the variables available in the given dataframe for
+    several moving average windows at once, along the dimensions (ell, row).
+    All the windows are found from one set of cumulative sums per variable.
+    The averages are taken separately within each profile, so they never mix
+    values from different profiles
+
+    df                  A pandas dataframe with the rows of each profile together
+                            and in order, with `Time` in the index
+    list_of_m_avg_wins  A list of the values of the moving average windows in dbar
+    vars_available      A list of variables available in the dataframe
+    res                 The vertical resolution of the data in dbar
+    """
+    ds_m_avgs = xr.Dataset(coords={'ell':('ell', list_of_m_avg_wins, {'units':'dbar', 'label':r'$\ell$ (dbar)'})})
+    # Find the variables to average, those with an ma_ or la_ variable requested
+    avg_vars = []
+    for var in ['iT', 'CT', 'PT', 'SP', 'SA', 'sigma']:
+        if var in df.columns and any(this_var in vars_available for this_var in [var, 'ma_'+var, 'la_'+var]):
+            avg_vars.append(var)
+    if len(avg_vars) == 0:
+        return ds_m_avgs
+    # Find the number of rows in each profile, which start wherever `Time` changes
+    if 'Time' in df.index.names:
+        pf_times = df.index.get_level_values('Time').values
+        pf_starts = np.flatnonzero(np.concatenate([[True], pf_times[1:] != pf_times[:-1]]))
+        row_size = np.diff(np.append(pf_starts, len(df)))
+    else:
+        row_size = [len(df)]
+    # Take the centered boxcar averages of all the variables at once
+    #   Values within window/2 of the ends of each profile, or whose window
+    #   includes a NaN, are masked
+    #   dividing m_avg_win by the resolution to get the number of data points
+    list_of_n_pts = [int(m_avg_win/res) for m_avg_win in list_of_m_avg_wins]
+    ma_arrs = dhf.ragged_boxcar_averages(df[avg_vars].values.T, row_size, list_of_n_pts)
+    for i in range(len(avg_vars)):
+        var = avg_vars[i]
+        ds_m_avgs['ma_'+var] = (['ell', 'row'], ma_arrs[:,i,:])
+        if 'la_'+var in vars_available:
+            ds_m_avgs['la_'+var] = (['ell', 'row'], df[var].values[np.newaxis,:] - ma_arrs[:,i,:])
         #
     #
-    return df
+    return ds_m_avgs
 
 ################################################################################
 
@@ -1415,6 +1641,11 @@ def make_figure(groups_to_plot, filename=None, use_same_x_axis=None, use_same_y_
     row_col_list        [rows, cols, f_ratio, f_size], if none given, will use 
                         the defaults specified below in n_row_col_dict
     """
+    # Make the dataframes for all the groups before plotting anything. By now,
+    #   all the groups have asked for their variables, so each data set reads
+    #   all the variables its groups need at once
+    for group in groups_to_plot:
+        group.data_frames
     # Define number of rows and columns based on number of subplots
     #   key: number of subplots, value: (rows, cols, f_ratio, f_size)
     n_row_col_dict = {'1':[1,1, 0.8, 1.25], '2':[1,2, 0.5, 1.25], '2.5':[2,1, 0.8, 1.25],
@@ -4103,6 +4334,18 @@ def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
         print('\tNumber of profiles:',number_of_pfs)
         z_list = np.array(z_list)
         z_list = z_list[z_list <= number_of_pfs]
+    # If sweeping the moving average window, take the moving averages for all
+    #   the windows at once, applied to the original data before the data
+    #   filters, so make a new Analysis_Group
+    if x_key == 'ell_size' or z_key == 'ell_size':
+        # Copy the profile filters so the given Analysis_Group isn't changed
+        ell_pfs = copy.copy(a_group.profile_filters)
+        if x_key == 'ell_size':
+            ell_pfs.m_avg_win = list(x_var_array)
+        else:
+            ell_pfs.m_avg_win = list(z_list)
+        ell_group = Analysis_Group(a_group.data_set, ell_pfs, a_group.plt_params)
+        ell_df = pd.concat(ell_group.data_frames)
     #
     print('\tPlotting these x values of',x_key,':',x_var_array)
     f = open(sweep_txt_file,'a')
@@ -4125,18 +4368,12 @@ def plot_clstr_param_sweep(ax, tw_ax_x, a_group, plt_title=None):
             # Set parameters based on variables selected
             #   NOTE: need to run `ell_size` BEFORE `n_pfs`
             if x_key == 'ell_size':
-                # Need to apply moving average window to original data, before
-                #   the data filters were applied, so make a new Analysis_Group
-                a_group.profile_filters.m_avg_win = x
-                new_a_group = Analysis_Group(a_group.data_set, a_group.profile_filters, a_group.plt_params)
-                this_df = pd.concat(new_a_group.data_frames)
+                # Select the data with this moving average window
+                this_df = ell_df.xs(x, level='ell').copy()
                 xlabel = r'$\ell$ (dbar)'
             if z_key == 'ell_size':
-                # Need to apply moving average window to original data, before
-                #   the data filters were applied, so make a new Analysis_Group
-                a_group.profile_filters.m_avg_win = z_list[i]
-                new_a_group = Analysis_Group(a_group.data_set, a_group.profile_filters, a_group.plt_params)
-                this_df = pd.concat(new_a_group.data_frames)
+                # Select the data with this moving average window
+                this_df = ell_df.xs(z_list[i], level='ell').copy()
                 zlabel = r'$\ell=$'+str(z_list[i])+' dbar'
             if x_key == 'n_pfs':
                 this_df = this_df[this_df['prof_no'] <= pf_nos[x-1]].copy()
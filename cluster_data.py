@@ -35,6 +35,8 @@ import gsw
 
 # For custom analysis functions
 import analysis_helper_functions as ahf
+# For the encodings to use when writing netcdfs
+import data_helper_functions as dhf
 
 ################################################################################
 # Main execution
@@ -78,10 +80,11 @@ for clstr_dict in [ITP2_clstr_dict, ITP3_clstr_dict]:
     ds = xarrs[0]
 
     # Convert a subset of the dataset to a dataframe
-    og_df = ds[['cluster', 'clst_prob']].squeeze().to_dataframe()
-    # Get the original dimensions of the data to reshape the arrays later
-    len0 = len(og_df.index.get_level_values(0).unique())
-    len1 = len(og_df.index.get_level_values(1).unique())
+    #   Works for both padded and ragged netcdfs
+    og_df = dhf.profiles_to_dataframe(ds, ['cluster', 'clst_prob'])
+    # Get the original shape of the vertical data to reshape the arrays later
+    #   (Time, Vertical) for padded netcdfs, (obs) for ragged netcdfs
+    vert_shape = ds['cluster'].shape
     # print('Dataframe from netcdf, selected columns:')
     # print(og_df)
     # print('')
@@ -119,8 +122,8 @@ for clstr_dict in [ITP2_clstr_dict, ITP3_clstr_dict]:
     # print('Dataframe from netcdf, non-NaN rows:')
     # print(og_df[~og_df.isnull().any(axis=1)])
     # Put the clustering variables back into the dataset
-    ds['cluster'].values   = og_df['cluster'].values.reshape((len0, len1))
-    ds['clst_prob'].values = og_df['clst_prob'].values.reshape((len0, len1))
+    ds['cluster'].values   = og_df['cluster'].values.reshape(vert_shape)
+    ds['clst_prob'].values = og_df['clst_prob'].values.reshape(vert_shape)
     # Update the global variables:
     ds.attrs['Last modified'] = str(datetime.now())
     ds.attrs['Last modification'] = 'Updated clustering'
@@ -130,11 +133,11 @@ for clstr_dict in [ITP2_clstr_dict, ITP3_clstr_dict]:
     ds.attrs['Clustering m_pts'] = clstr_dict['m_pts']
     ds.attrs['Clustering filters'] = ahf.print_profile_filters(clstr_dict['pfs_object'])
     ds.attrs['Clustering DBCV'] = group_test_clstr.data_set.arr_of_ds[0].attrs['Clustering DBCV']
-    # Write out to netcdf
+    # Write out to netcdf, or just the changed variables to a zarr store
     print('Writing data to',my_nc)
-    ds.to_netcdf(my_nc, 'w')
+    dhf.update_dataset_vars(ds, my_nc, ['cluster','clst_prob'])
     # Load in with xarray
-    ds2 = xr.load_dataset(my_nc)
+    ds2 = dhf.load_dataset(my_nc)
     # See the variables after
     for attr in gattrs_to_print:
         print('\t',attr+':',ds2.attrs[attr])
@@ -0,0 +1,1139 @@
+"""
+Author: Mikhail Schee
+Created: 2026-10-17
+
+This script contains helper functions shared by the scripts which make, modify,
+and read the netcdfs of Arctic Ocean profile data
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
+
+    1. Redistributions in source code must retain the accompanying copyright notice, this list of conditions, and the following disclaimer.
+    2. Redistributions in binary form must reproduce the accompanying copyright notice, this list of conditions, and the following disclaimer in the documentation and/or other materials provided with the distribution.
+    3. Names of the copyright holders must not be used to endorse or promote products derived from this software without prior written permission from the copyright holders.
+    4. If any files are modified, you must cause the modified files to carry prominent notices stating that you changed the files and the date of any change.
+
+Disclaimer
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS "AS IS" AND ANY EXPRESSED OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+# For writing variables into part of an existing netcdf
+import netCDF4 as netcdf
+# For checking which datasets exist
+import os
+
+################################################################################
+# Declare variables for writing netcdfs
+################################################################################
+
+# Variables that only ever hold small integers, and the integer types and fill
+#   values to store them as. Note: can't use -1 as the fill value for `cluster`
+#   because -1 is the label for noise points
+int_encodings = {
+                 'cluster':{'dtype':'int16', '_FillValue':np.iinfo('int16').min},
+                 'ss_mask':{'dtype':'int8', '_FillValue':np.iinfo('int8').min}
+}
+
+# The geographical regions of the Arctic Ocean, following
+#   Peralta-Ferriz and Woodgate (2015), doi:10.1016/j.pocean.2014.12.005
+#   The `region` variable stores the index of the region in this list, 0 for
+#   profiles outside all the regions, and -1 for profiles without a location
+region_names = ['none', 'CS', 'SBS', 'CB', 'MB', 'EB', 'BS']
+region_codes = dict(zip(region_names, range(len(region_names))))
+region_codes['error'] = -1
+# The bounds of each region as [name, lon_min, lon_max, lat_min, lat_max]
+#   Note: the regions are checked in this order and the first match is used
+region_bounds = [
+                 ['CS',  -180, -155, 68,   76],   # Chukchi Sea
+                 ['SBS', -155, -120, 68,   72],   # Southern Beaufort Sea
+                 ['CB',  -155, -130, 72,   84],   # Canada Basin
+                 ['MB',    50,  180, 83.5, 90],   # Makarov Basin part 1
+                 ['MB',   141,  180, 78,   90],   # Makarov Basin part 2
+                 ['EB',    30,  140, 82,   90],   # Eurasian Basin part 1
+                 ['EB',   110,  140, 78,   82],   # Eurasian Basin part 2
+                 ['BS',    15,   60, 75,   80],   # Barents Sea part 1
+                 ['BS',    15,   55, 67,   75]    # Barents Sea part 2
+]
+
+################################################################################
+# Define functions for reading and writing netcdfs or zarr stores
+################################################################################
+
+# The datasets already read in this process, keyed by
+#   (absolute path, modification time, lazy, chunks), see `load_dataset_cached`
+dataset_cache = {}
+# Datasets can be stored either as netcdf files or as zarr directory stores,
+#   chosen by the path: paths ending in '.zarr' are zarr stores. Zarr stores
+#   keep each chunk of each variable in its own file, so single variables or
+#   disjoint chunks of profiles can be written without rewriting the rest
+
+def is_zarr_path(path):
+    """
+    Returns True if the given path is for a zarr store rather than a netcdf
+
+    path                string of the file path of the dataset
+    """
+    return path.rstrip('/').endswith('.zarr')
+
+def find_dataset_path(source, data_dir='netcdfs/'):
+    """
+    Returns the path of the dataset for the given source, the netcdf if there
+    is one, otherwise the zarr store
+
+    source              string of the name of the dataset without the extension
+    data_dir            string of the directory which holds the datasets
+    """
+    if os.path.exists(data_dir+source+'.zarr') and not os.path.exists(data_dir+source+'.nc'):
+        return data_dir+source+'.zarr'
+    else:
+        return data_dir+source+'.nc'
+
+def load_dataset(path):
+    """
+    Returns the dataset at the given path loaded into memory
+
+    path                string of the file path of a netcdf or zarr store
+    """
+    if is_zarr_path(path):
+        return xr.open_zarr(path).load()
+    else:
+        return xr.load_dataset(path)
+
+def open_dataset(path, chunks='auto'):
+    """
+    Returns the dataset at the given path opened lazily, backed by dask arrays,
+    so that data is only read from disk when it is actually used. The
+    per-profile variables, which are small, are read in right away so that
+    profiles can be selected based on them
+
+    path                string of the file path of a netcdf or zarr store
+    chunks              the chunks to split the variables into, passed to
+                            `xr.open_dataset`, ex: {'Time':500} or 'auto'
+    """
+    if is_zarr_path(path):
+        ds = xr.open_zarr(path, chunks=chunks)
+    else:
+        ds = xr.open_dataset(path, chunks=chunks)
+    for var in ds.data_vars:
+        if 'Time' in ds[var].dims and not any(dim in vert_dims for dim in ds[var].dims):
+            ds[var] = ds[var].load()
+    return ds
+
+def get_mtime(path):
+    """
+    Returns the last modification time of the dataset at the given path. For
+    zarr stores, that's the latest of all the files in the store, since
+    updating some variables doesn't change the time of the directory itself
+
+    path                string of the file path of a netcdf or zarr store
+    """
+    if is_zarr_path(path):
+        mtime = os.path.getmtime(path)
+        for dir_path, dir_names, file_names in os.walk(path):
+            for file_name in file_names:
+                mtime = max(mtime, os.path.getmtime(os.path.join(dir_path, file_name)))
+        return mtime
+    else:
+        return os.path.getmtime(path)
+
+def load_dataset_cached(path, lazy=False, chunks='auto'):
+    """
+    Returns a read-only view of the dataset at the given path. The dataset is
+    only read from disk the first time it is asked for in this process, or
+    again if the file has been modified since. The arrays of the view can't be
+    changed in place, but variables can be added to or replaced in the view
+    without affecting the cached dataset or other views
+
+    path                string of the file path of a netcdf or zarr store
+    lazy                True/False whether to open the dataset lazily with
+                            `open_dataset` instead of loading it into memory
+    chunks              the chunks to split the variables into if lazy
+    """
+    key = (os.path.abspath(path), get_mtime(path), lazy, str(chunks))
+    if key not in dataset_cache.keys():
+        # Remove any out of date versions of this dataset from the cache
+        for old_key in [old_key for old_key in dataset_cache.keys() if old_key[0] == key[0] and old_key[1] != key[1]]:
+            dataset_cache.pop(old_key).close()
+        if lazy:
+            ds = open_dataset(path, chunks)
+        else:
+            ds = load_dataset(path)
+        # Make sure the cached arrays don't get modified through a view
+        for var in ds.variables.values():
+            if isinstance(var.data, np.ndarray):
+                var.data.flags.writeable = False
+        dataset_cache[key] = ds
+    # A shallow copy shares the arrays, but not the dictionary of variables
+    return dataset_cache[key].copy(deep=False)
+
+def evict_cached_dataset(path):
+    """
+    Closes and removes any cached versions of the dataset at the given path
+    from the cache used by `load_dataset_cached`. Lazily opened datasets keep
+    their file open, which stops it from being written to, so this is called
+    before writing to any dataset
+
+    path                string of the file path of a netcdf or zarr store
+    """
+    for key in [key for key in dataset_cache.keys() if key[0] == os.path.abspath(path)]:
+        dataset_cache.pop(key).close()
+    #
+
+def clear_dataset_cache():
+    """
+    Closes and removes all datasets from the cache used by `load_dataset_cached`
+    """
+    for key in list(dataset_cache.keys()):
+        dataset_cache.pop(key).close()
+    #
+
+def get_zarr_encoding(ds, pfs_per_chunk=64, float_dtype='float32', obs_per_chunk=65536):
+    """
+    Returns a dictionary of encodings to pass to `to_zarr`, with the same dtypes
+    as `get_nc_encoding` and chunks of several profiles, since each chunk is a
+    separate file. The zarr default compressor is used
+
+    ds                  An xarray dataset to be written to a zarr store
+    pfs_per_chunk       integer number of profiles to store in each chunk
+    float_dtype         string of the float dtype in which to store the measured
+                            and derived variables along `Vertical`, or None to
+                            keep the dtypes they have in the dataset
+    obs_per_chunk       integer number of observations to store in each chunk
+                            of the variables along `obs` in ragged datasets
+    """
+    nc_encoding = get_nc_encoding(ds, pfs_per_chunk=pfs_per_chunk, float_dtype=float_dtype, obs_per_chunk=obs_per_chunk)
+    encoding = {}
+    for var in nc_encoding.keys():
+        encoding[var] = {key:nc_encoding[var][key] for key in ['dtype', '_FillValue'] if key in nc_encoding[var].keys()}
+        if 'chunksizes' in nc_encoding[var].keys():
+            encoding[var]['chunks'] = nc_encoding[var]['chunksizes']
+        elif 'Time' in ds[var].dims:
+            encoding[var]['chunks'] = tuple(min(pfs_per_chunk, ds.sizes[dim]) if dim == 'Time' else ds.sizes[dim] for dim in ds[var].dims)
+    return encoding
+
+def write_dataset(ds, path):
+    """
+    Writes out the whole dataset to the given path, replacing what was there
+
+    ds                  An xarray dataset
+    path                string of the file path of a netcdf or zarr store
+    """
+    # The dataset may be lazily read from the file it's replacing, so read it
+    #   in before closing any cached handles to that file
+    if os.path.exists(path):
+        ds = ds.compute()
+    evict_cached_dataset(path)
+    if is_zarr_path(path):
+        ds.to_zarr(path, mode='w', encoding=get_zarr_encoding(ds))
+    else:
+        # With `Time`, and `obs` for ragged datasets, as unlimited dimensions
+        #   so that new profiles can be appended along them, see `append_profiles`
+        ds.to_netcdf(path, 'w', unlimited_dims=[dim for dim in ['Time', 'obs'] if dim in ds.dims], encoding=get_nc_encoding(ds))
+
+def update_dataset_vars(ds, path, vars_to_update):
+    """
+    Writes the given variables and the global attributes of the dataset to the
+    given path. Zarr stores only have those variables rewritten, netcdfs are
+    rewritten in full
+
+    ds                  An xarray dataset, with the same dimensions as the one
+                            already at `path`
+    path                string of the file path of a netcdf or zarr store
+    vars_to_update      list of strings of the variables to write
+    """
+    if is_zarr_path(path):
+        # Variables can only be overwritten in place if their dimensions, and
+        #   any coordinates along them other than `Time`, are the same as in
+        #   the store. Otherwise, the whole store is rewritten
+        ds_old = xr.open_zarr(path)
+        for var in vars_to_update:
+            if var not in ds_old.data_vars or ds_old[var].dims != ds[var].dims:
+                write_dataset(ds, path)
+                return
+            for dim in ds[var].dims:
+                if dim != 'Time' and dim in ds.coords and not np.array_equal(ds[dim].values, ds_old[dim].values):
+                    write_dataset(ds, path)
+                    return
+                #
+            #
+        # Mode 'a' overwrites the variables which already exist in the store
+        ds_update = ds[vars_to_update].compute()
+        evict_cached_dataset(path)
+        ds_update = ds_update.drop_vars([coord for coord in ds_update.coords])
+        ds_update.attrs = ds.attrs
+        ds_update.to_zarr(path, mode='a')
+    else:
+        write_dataset(ds, path)
+
+def write_vars_region(ds, path, region):
+    """
+    Writes the variables of the given dataset into a region of the same
+    variables of an existing netcdf or zarr store, in place, without touching
+    the rest of the file. Netcdfs are opened in append mode with netCDF4, so
+    only the given values are held in memory. The variables must already exist
+    in the file with the same dimensions
+
+    ds                  An xarray dataset of just the variables to write, with
+                            the size of the region along its dimensions
+    path                string of the file path of a netcdf or zarr store
+    region              dictionary of the slice to write along each dimension,
+                            ex: {'Time':slice(0,500)}. Dimensions which are not
+                            given are written in full
+    """
+    # Read in the values before closing any cached handles to the file, in
+    #   case they are lazily read from it
+    ds = ds.compute()
+    evict_cached_dataset(path)
+    if is_zarr_path(path):
+        ds_region = ds.drop_vars([coord for coord in ds.coords])
+        ds_region.to_zarr(path, region={dim:region[dim] for dim in region.keys() if dim in ds.dims})
+    else:
+        with netcdf.Dataset(path, 'a') as nc:
+            for var in ds.data_vars:
+                nc_dims = nc[var].dimensions
+                index = tuple(region.get(dim, slice(None)) for dim in nc_dims)
+                nc[var][index] = ds[var].transpose(*nc_dims).values
+            #
+        #
+
+def update_dataset_attrs(path, attrs):
+    """
+    Updates the global attributes of an existing netcdf or zarr store, in place
+
+    path                string of the file path of a netcdf or zarr store
+    attrs               dictionary of the global attributes to set
+    """
+    evict_cached_dataset(path)
+    if is_zarr_path(path):
+        xr.Dataset(attrs=attrs).to_zarr(path, mode='a')
+    else:
+        with netcdf.Dataset(path, 'a') as nc:
+            nc.setncatts(attrs)
+        #
+
+def append_profiles(ds, path):
+    """
+    Appends the profiles of the given dataset to the end of an existing netcdf
+    or zarr store, in place, without reading or rewriting the profiles already
+    there. The observations of ragged datasets are appended along `obs` too.
+    The global attributes of the file are replaced by those of the dataset.
+    Returns True if the profiles were appended, or False, without writing
+    anything, if the dataset doesn't fit the layout of the file, in which case
+    the whole file has to be rewritten with `write_dataset`. That's the case
+    when the file has different variables, padded profiles shorter than the new
+    ones, a pressure grid that doesn't cover the new profiles, or, for netcdfs,
+    fixed size `Time` or `obs` dimensions
+
+    ds                  An xarray dataset of the new profiles, stored the same
+                            way as those in the file (padded, gridded, or ragged)
+    path                string of the file path of a netcdf or zarr store
+    """
+    ds = ds.compute()
+    evict_cached_dataset(path)
+    # Open the file just to compare its layout to that of the new profiles
+    if is_zarr_path(path):
+        ds_old = xr.open_zarr(path)
+    else:
+        ds_old = xr.open_dataset(path)
+    with ds_old:
+        append_dims = [dim for dim in ['Time', 'obs'] if dim in ds_old.dims]
+        if set(ds.data_vars) != set(ds_old.data_vars) or any(dim not in ds.dims for dim in append_dims):
+            return False
+        # Pad the new profiles to the length of those in the file, or put them
+        #   on the file's pressure grid
+        for dim in ['Vertical', 'press_level']:
+            if dim in ds_old.dims:
+                if dim not in ds.dims or not np.all(np.isin(ds[dim].values, ds_old[dim].values)):
+                    return False
+                ds = ds.reindex({dim:ds_old[dim].values})
+            #
+        # Add the coordinates of any other dimensions the new profiles don't
+        #   have yet, like `ell`
+        for dim in ds_old.dims:
+            if dim not in ds.dims and dim in ds_old.coords:
+                ds = ds.assign_coords({dim:ds_old[dim].values})
+            #
+        old_vars = [var for var in ds_old.variables if any(dim in ds_old[var].dims for dim in append_dims)]
+        for var in old_vars:
+            if var not in ds.variables:
+                return False
+            # Variables without any values yet for the new profiles, like moving
+            #   averages along `ell`, can be broadcast to the shape in the file
+            if ds[var].dims != ds_old[var].dims:
+                if set(ds[var].dims) <= set(ds_old[var].dims) and ds[var].isnull().all():
+                    shape = tuple(ds.sizes[dim] if dim in append_dims else ds_old.sizes[dim] for dim in ds_old[var].dims)
+                    ds[var] = (ds_old[var].dims, np.full(shape, np.nan), ds[var].attrs)
+                else:
+                    return False
+            # Strings can't be written into numeric variables, or the reverse
+            if (ds[var].dtype.kind in 'OSU') != (ds_old[var].dtype.kind in 'OSU'):
+                return False
+            # NaNs can't be written into boolean variables, or integer ones
+            #   without a fill value, which are read in as floats
+            if ds_old[var].dtype.kind in 'biu' and ds[var].dtype.kind == 'f' and ds[var].isnull().any():
+                return False
+            # Any other dimensions must have the same coordinates
+            for dim in ds_old[var].dims:
+                if dim in append_dims:
+                    continue
+                if ds.sizes[dim] != ds_old.sizes[dim] or (dim in ds_old.coords and not np.array_equal(ds[dim].values, ds_old[dim].values)):
+                    return False
+                #
+            #
+        if is_zarr_path(path):
+            n_old = None
+        else:
+            n_old = {dim:ds_old.sizes[dim] for dim in append_dims}
+    if is_zarr_path(path):
+        # Append the variables along each dimension separately
+        for dim in append_dims:
+            these_vars = [var for var in old_vars if dim in ds_old[var].dims]
+            ds_append = ds[these_vars]
+            ds_append = ds_append.drop_vars([coord for coord in ds_append.coords if coord not in these_vars])
+            ds_append.to_zarr(path, append_dim=dim)
+        #
+    else:
+        with netcdf.Dataset(path, 'a') as nc:
+            if any(not nc.dimensions[dim].isunlimited() for dim in append_dims):
+                return False
+            for var in old_vars:
+                nc_dims = nc[var].dimensions
+                index = tuple(slice(n_old[dim], n_old[dim]+ds.sizes[dim]) if dim in append_dims else slice(None) for dim in nc_dims)
+                values = ds[var].transpose(*nc_dims).values
+                # NaNs are written as the fill value of integer variables
+                if values.dtype.kind == 'f' and np.dtype(nc[var].dtype).kind in 'iu' and '_FillValue' in nc[var].ncattrs():
+                    values = np.where(np.isnan(values), nc[var]._FillValue, values)
+                if values.dtype.kind in 'bf' and np.dtype(nc[var].dtype).kind in 'iu':
+                    values = values.astype(nc[var].dtype)
+                nc[var][index] = values
+            #
+        #
+    update_dataset_attrs(path, ds.attrs)
+    return True
+
+################################################################################
+# Define functions for geographical regions
+################################################################################
+
+def find_geo_regions(lons, lats):
+    """
+    Returns an int8 array of the codes of the geographical regions of the Arctic
+    Ocean in which the given points are (see `region_names`)
+
+    lons                array of longitude values, NaN or None if missing
+    lats                array of latitude values, NaN or None if missing
+    """
+    lons = np.asarray(lons, dtype='float64')
+    lats = np.asarray(lats, dtype='float64')
+    conditions = [(lons > lon0) & (lons < lon1) & (lats > lat0) & (lats < lat1) for name, lon0, lon1, lat0, lat1 in region_bounds]
+    choices = [region_codes[name] for name in [bounds[0] for bounds in region_bounds]]
+    # `select` takes the first condition that's true for each point
+    regions = np.select(conditions, choices, default=region_codes['none']).astype('int8')
+    regions[np.isnan(lons) | np.isnan(lats)] = region_codes['error']
+    return regions
+
+def region_mask(regions, geo_extent):
+    """
+    Returns a boolean array of which values of `regions` are in the given extent
+
+    regions             array of region codes, or of region name strings as in
+                            netcdfs made before the regions were stored as codes
+    geo_extent          string of a region name (ex: 'CB') or a list of them
+    """
+    if isinstance(geo_extent, str):
+        geo_extent = [geo_extent]
+    regions = np.asarray(regions)
+    # Note: `where` turns the integer codes into floats
+    if regions.dtype.kind in 'iuf':
+        return np.isin(regions, [region_codes[name] for name in geo_extent])
+    else:
+        return np.isin(regions.astype(str), geo_extent)
+
+################################################################################
+# Define functions for writing netcdfs
+################################################################################
+
+def get_nc_encoding(ds, complevel=4, pfs_per_chunk=1, float_dtype='float32', obs_per_chunk=16384):
+    """
+    Returns a dictionary of encodings to pass to `to_netcdf` so that the
+    variables of the given dataset are compressed and chunked along `Time`
+
+    ds                  An xarray dataset to be written to a netcdf
+    complevel           integer from 1 to 9 of the zlib compression level
+    pfs_per_chunk       integer number of profiles to store in each chunk
+    float_dtype         string of the float dtype in which to store the measured
+                            and derived variables along `Vertical`, or None to
+                            keep the dtypes they have in the dataset
+    obs_per_chunk       integer number of observations to store in each chunk
+                            of the variables along `obs` in ragged datasets
+    """
+    encoding = {}
+    for var in ds.variables:
+        this_var = ds[var]
+        # Don't try to compress the dimensions or strings
+        if var in ds.dims or this_var.dtype.kind not in 'biuf':
+            continue
+        this_enc = {'zlib':True, 'complevel':complevel, 'shuffle':True}
+        # Chunk the profile variables along `Time`, keeping whole profiles together,
+        #   or along `obs` for ragged datasets
+        if any(dim in vert_dims for dim in this_var.dims) and this_var.size > 0:
+            chunksizes = []
+            for dim in this_var.dims:
+                if dim == 'Time':
+                    chunksizes.append(min(pfs_per_chunk, ds.sizes[dim]))
+                elif dim == 'obs':
+                    chunksizes.append(min(obs_per_chunk, ds.sizes[dim]))
+                elif dim == 'ell':
+                    # Each moving average window can be read on its own
+                    chunksizes.append(1)
+                else:
+                    chunksizes.append(ds.sizes[dim])
+            this_enc['chunksizes'] = tuple(chunksizes)
+            # Use a smaller type for the variables that only hold integers
+            if var in int_encodings.keys() and this_var.dtype.kind == 'f':
+                this_enc.update(int_encodings[var])
+            elif this_var.dtype.kind == 'f' and not isinstance(float_dtype, type(None)):
+                this_enc['dtype'] = float_dtype
+            #
+        encoding[var] = this_enc
+    return encoding
+
+################################################################################
+# Define functions for uniform pressure grids
+################################################################################
+# Instead of keeping the measured pressures, profiles can be interpolated onto
+#   a shared, uniform pressure grid when the netcdf is made. Those netcdfs have
+#   a `press_level` dimension, with the pressure of each level as its coordinate,
+#   in place of `Vertical`, and the spacing in the global attribute
+#   'Pressure grid spacing'
+
+def grid_profiles(press_arr, list_of_arrs, press_grid, vert_dtype='float64'):
+    """
+    Returns an array of the pressure levels of a uniform grid covering all the
+    given profiles, an array of the pressures of the levels within the range
+    of each profile (NaN outside), and the given arrays linearly interpolated
+    onto those levels, each with the shape (number of profiles, number of levels).
+    All the profiles are interpolated at once, see `stack_profiles`
+
+    press_arr           array of pressure values with the shape (Time, Vertical)
+    list_of_arrs        list of arrays of the same shape as press_arr to interpolate
+    press_grid          float of the spacing of the grid in dbar
+    vert_dtype          string of the float dtype of the output arrays
+    """
+    # Make the levels line up with multiples of the grid spacing
+    p_min = np.floor(np.nanmin(press_arr)/press_grid)*press_grid
+    p_max = np.ceil(np.nanmax(press_arr)/press_grid)*press_grid
+    press_levels = np.round(np.arange(p_min, p_max+press_grid/2, press_grid), 6)
+    gridded_press = np.full((press_arr.shape[0], len(press_levels)), np.nan, dtype=vert_dtype)
+    gridded_arrs = [np.full(gridded_press.shape, np.nan, dtype=vert_dtype) for arr in list_of_arrs]
+    # `interp` needs increasing pressures without NaNs, but up-casts decrease
+    order, is_value, starts, n_values, shifts, keys = stack_profiles(press_arr)
+    ends = starts + n_values - 1
+    # Only fill the levels within the range of each profile
+    has_values = n_values > 0
+    p_first = np.full(len(n_values), np.nan)
+    p_last  = np.full(len(n_values), np.nan)
+    p_first[has_values] = keys[starts[has_values]] - shifts[has_values]
+    p_last[has_values]  = keys[ends[has_values]] - shifts[has_values]
+    in_range = (press_levels >= p_first[:,np.newaxis]) & (press_levels <= p_last[:,np.newaxis])
+    rows, cols = np.nonzero(in_range)
+    gridded_press[rows, cols] = press_levels[cols]
+    # Find the measurements on either side of each level, within its profile
+    targets = press_levels[cols] + shifts[rows]
+    i0 = np.clip(np.searchsorted(keys, targets, side='right') - 1, starts[rows], np.maximum(ends[rows]-1, starts[rows]))
+    i1 = np.minimum(i0+1, ends[rows])
+    d_press = keys[i1] - keys[i0]
+    weight = np.where(d_press > 0, (targets - keys[i0])/np.where(d_press > 0, d_press, 1), 0)
+    for arr, gridded_arr in zip(list_of_arrs, gridded_arrs):
+        values = np.take_along_axis(np.asarray(arr), order, axis=1)[is_value]
+        # Levels right on a measurement take its value, like `np.interp`
+        gridded_arr[rows, cols] = np.where(weight == 0, values[i0], np.where(weight == 1, values[i1], values[i0] + weight*(values[i1] - values[i0])))
+    return press_levels, gridded_press, gridded_arrs
+
+def stack_profiles(vert_arr):
+    """
+    Returns what is needed to search through all the profiles of the given array
+    at once with `np.searchsorted`, as in `grid_profiles`. That is, the values
+    of each profile sorted in increasing order and shifted up past the values of
+    the profile before, so that all the profiles make one increasing array
+
+    Returns:
+    order               array of the indices that sort each profile, NaNs last
+    is_value            boolean array of which sorted values aren't NaNs
+    starts              array of the index in `keys` of the first value of each profile
+    n_values            array of the number of values in each profile
+    shifts              array of how much each profile was shifted by
+    keys                1D array of the shifted, sorted values of all the profiles
+
+    vert_arr            array of vertical values with the shape (Time, Vertical)
+    """
+    vert_arr = np.asarray(vert_arr, dtype='float64')
+    n_pfs, n_vert = vert_arr.shape
+    order = np.argsort(vert_arr, axis=1, kind='stable')
+    n_values = np.sum(~np.isnan(vert_arr), axis=1)
+    is_value = np.arange(n_vert) < n_values[:,np.newaxis]
+    starts = np.cumsum(n_values) - n_values
+    if n_values.sum() == 0:
+        return order, is_value, starts, n_values, np.zeros(n_pfs), np.array([])
+    # Shift each profile past the range of all the values
+    v_min = np.nanmin(vert_arr)
+    span = np.nanmax(vert_arr) - v_min + 1
+    shifts = np.arange(n_pfs)*span - v_min
+    keys = (np.take_along_axis(vert_arr, order, axis=1) + shifts[:,np.newaxis])[is_value]
+    return order, is_value, starts, n_values, shifts, keys
+
+def is_gridded(ds):
+    """
+    Returns True if the profiles of the given dataset are on a uniform pressure grid
+
+    ds                  An xarray dataset
+    """
+    return 'press_level' in ds.dims
+
+def get_vert_res(ds):
+    """
+    Returns the vertical resolution of the given dataset in dbar. That is the
+    grid spacing for gridded datasets, otherwise the median spacing between
+    consecutive pressure measurements
+
+    ds                  An xarray dataset
+    """
+    if is_gridded(ds):
+        return float(ds.attrs['Pressure grid spacing'].split()[0])
+    press = ds['press'].values
+    if press.ndim > 1:
+        d_press = np.diff(press, axis=-1)
+    else:
+        # For ragged datasets, there are only a few jumps between profiles
+        d_press = np.diff(press)
+    return float(np.nanmedian(np.abs(d_press)))
+
+def ragged_boxcar_averages(arr, row_size, list_of_n_pts):
+    """
+    Returns the centered moving averages of the given array for several window
+    sizes at once, found from the same cumulative sums, along a new first axis.
+    Each is taken separately over each profile stored one after another along
+    the last axis, as in ragged datasets, and is the same as pandas'
+    `rolling(window=n_pts, center=True, win_type='boxcar')` on that profile.
+    So values whose window runs past either end of their profile or includes
+    a NaN are NaN, and no window ever includes values from two profiles
+
+    arr                 array of values with the profiles one after another
+                            along the last axis, ex: (n_vars, obs)
+    row_size            array of the number of values in each profile
+    list_of_n_pts       list of the integer numbers of points to average across
+    """
+    arr = np.asarray(arr, dtype='float64')
+    row_size = np.asarray(row_size, dtype='int64')
+    n_obs = arr.shape[-1]
+    out = np.full((len(list_of_n_pts),)+arr.shape, np.nan)
+    if n_obs == 0:
+        return out
+    # Find the first value of each value's profile, and the one after its last
+    pf_start = np.repeat(np.cumsum(row_size) - row_size, row_size)
+    pf_end   = pf_start + np.repeat(row_size, row_size)
+    # Take cumulative sums of the values and of the number of NaNs, with a zero
+    #   in front, so the sum over any window is the difference of two values
+    is_nan = np.isnan(arr)
+    zeros = np.zeros(arr.shape[:-1]+(1,))
+    cum_sum = np.concatenate([zeros, np.cumsum(np.where(is_nan, 0, arr), axis=-1)], axis=-1)
+    cum_nan = np.concatenate([zeros, np.cumsum(is_nan, axis=-1)], axis=-1)
+    for k in range(len(list_of_n_pts)):
+        n_pts = int(list_of_n_pts[k])
+        if n_pts < 1:
+            continue
+        # The window of point i covers i-n_pts//2 to i-n_pts//2+n_pts-1
+        win_start = np.arange(n_obs) - n_pts//2
+        win_end   = win_start + n_pts
+        in_pf = (win_start >= pf_start) & (win_end <= pf_end)
+        i0 = win_start[in_pf]
+        i1 = win_end[in_pf]
+        win_sum = cum_sum[..., i1] - cum_sum[..., i0]
+        win_nan = cum_nan[..., i1] - cum_nan[..., i0]
+        out[k][..., in_pf] = np.where(win_nan > 0, np.nan, win_sum/n_pts)
+    return out
+
+################################################################################
+# Define functions for contiguous ragged array storage
+################################################################################
+# Instead of padding every profile to the length of the longest one along the
+#   `Vertical` dimension, ragged datasets store the profiles one after another
+#   along a flat `obs` dimension, following the CF conventions for a
+#   "contiguous ragged array". The per-profile variable `row_size` gives the
+#   number of observations in each profile
+
+def is_ragged(ds):
+    """
+    Returns True if the given dataset is stored as a contiguous ragged array
+
+    ds                  An xarray dataset
+    """
+    return 'obs' in ds.dims
+
+def padded_to_ragged(ds, row_size):
+    """
+    Returns the given dataset with all variables along `Vertical` converted to
+    a contiguous ragged array along `obs`, dropping the padding
+
+    ds                  An xarray dataset with `Time` and `Vertical` dimensions
+    row_size            array of the number of observations in each profile
+    """
+    row_size = np.asarray(row_size, dtype='int64')
+    # Find which values of the padded arrays are actual observations
+    is_obs = np.arange(ds.sizes['Vertical'])[np.newaxis,:] < row_size[:,np.newaxis]
+    vert_vars = [var for var in ds.data_vars if 'Vertical' in ds[var].dims]
+    ragged_vars = {}
+    for var in vert_vars:
+        # Boolean indexing of the (Time, Vertical) array keeps the profiles in order
+        ragged_vars[var] = (['obs'], ds[var].transpose('Time','Vertical').values[is_obs], ds[var].attrs)
+    ds = ds.drop_vars(vert_vars+['Vertical']).assign(ragged_vars)
+    ds['row_size'] = (['Time'], row_size, {
+                            'units':'N/A',
+                            'label':'Number of observations',
+                            'long_name':'Number of observations in this profile',
+                            'sample_dimension':'obs'
+                        })
+    ds.attrs['featureType'] = 'profile'
+    return ds
+
+def get_obs_index(row_size, pf_idx):
+    """
+    Returns an array of the indices along `obs` of all the observations in the
+    given profiles, in the same order as the profiles
+
+    row_size            array of the number of observations in each profile
+    pf_idx              array of the indices along `Time` of the profiles
+    """
+    row_size = np.asarray(row_size, dtype='int64')
+    pf_idx = np.asarray(pf_idx, dtype='int64')
+    # Find where each profile starts in the original `obs` dimension
+    starts = np.cumsum(row_size) - row_size
+    new_sizes = row_size[pf_idx]
+    # Find where each profile will start in the new `obs` dimension
+    new_starts = np.cumsum(new_sizes) - new_sizes
+    # Shift the index of every new observation by how far its profile moved
+    return np.arange(new_sizes.sum()) + np.repeat(starts[pf_idx] - new_starts, new_sizes)
+
+def find_profile_index(ds, pf_list):
+    """
+    Returns an array of the indices along `Time` of the profiles with the given
+    profile numbers, in the order given, skipping any that aren't in the dataset
+
+    ds                  An xarray dataset with a `prof_no` variable
+    pf_list             A list of profile numbers
+    """
+    # Map each profile number to its position, all in one pass
+    pf_index = dict(zip(ds['prof_no'].values.tolist(), range(ds.sizes['Time'])))
+    missing_pfs = [pf for pf in pf_list if pf not in pf_index.keys()]
+    if len(missing_pfs) > 0:
+        print('Did not find profiles',missing_pfs)
+    return np.array([pf_index[pf] for pf in pf_list if pf in pf_index.keys()], dtype='int64')
+
+def select_profiles(ds, pf_idx):
+    """
+    Returns a dataset with just the given profiles, in the given order, for
+    either padded or ragged datasets
+
+    ds                  An xarray dataset
+    pf_idx              array of the indices along `Time` of the profiles to keep
+    """
+    pf_idx = np.asarray(pf_idx, dtype='int64')
+    if is_ragged(ds):
+        obs_idx = get_obs_index(ds['row_size'].values, pf_idx)
+        return ds.isel(Time=pf_idx, obs=obs_idx)
+    else:
+        return ds.isel(Time=pf_idx)
+
+def concat_profiles(ds_list):
+    """
+    Returns one dataset with the profiles of all the given datasets, one after
+    another. Padded datasets are joined on `Vertical`, padding the shorter
+    profiles with NaNs. Ragged datasets are joined along `Time` and `obs`.
+    The global attributes are taken from the first dataset
+
+    ds_list             A list of xarray datasets, either all padded or all ragged
+    """
+    if is_ragged(ds_list[0]):
+        # Split each dataset into its per-profile and per-observation variables.
+        #   Variables missing from some datasets are filled with NaNs
+        list_of_time_ds = []
+        list_of_obs_ds  = []
+        for ds in ds_list:
+            obs_vars = [var for var in ds.data_vars if 'obs' in ds[var].dims]
+            list_of_time_ds.append(ds.drop_vars(obs_vars))
+            list_of_obs_ds.append(ds[obs_vars])
+        ds_time = xr.concat(list_of_time_ds, dim='Time', combine_attrs='override')
+        ds_obs  = xr.concat(list_of_obs_ds, dim='obs', combine_attrs='override')
+        return xr.merge([ds_time, ds_obs], combine_attrs='override')
+    else:
+        return xr.concat(ds_list, dim='Time', join='outer', combine_attrs='override')
+
+def ragged_to_dataframe(ds, vars_to_keep, copy=True):
+    """
+    Returns a pandas dataframe of the given variables of a ragged dataset, with
+    one row per observation, without ever expanding into padded arrays. The
+    per-profile variables are repeated for every observation in the profile.
+    The index is (Time, Vertical), where `Vertical` is the position within the
+    profile, to match the dataframes made from padded datasets
+
+    ds                  An xarray dataset stored as a contiguous ragged array
+    vars_to_keep        A list of variables to include in the dataframe
+    copy                True/False whether to copy the variables along `obs`.
+                            If False, the columns share memory with the dataset,
+                            so the dataframe must not be modified in place
+    """
+    row_size = ds['row_size'].values
+    # Find the position of each observation within its profile
+    if 'Vertical' in ds.coords:
+        # The observations were selected by `select_levels`
+        vert_idx = ds['Vertical'].values
+    else:
+        starts = np.cumsum(row_size) - row_size
+        vert_idx = np.arange(row_size.sum()) - np.repeat(starts, row_size)
+    index = pd.MultiIndex.from_arrays([np.repeat(ds['Time'].values, row_size), vert_idx], names=['Time', 'Vertical'])
+    columns = {}
+    for var in vars_to_keep:
+        if 'obs' in ds[var].dims:
+            columns[var] = ds[var].values
+        else:
+            columns[var] = np.repeat(ds[var].values, row_size)
+    return pd.DataFrame(columns, index=index, copy=copy)
+
+def padded_to_dataframe(ds, vars_to_keep):
+    """
+    Returns a pandas dataframe of the given variables of a padded or gridded
+    dataset, with one row for each level that has a value in any of the
+    vertical variables, so the padding is never included. The per-profile
+    variables are repeated for every level kept in the profile. The index is
+    (Time, Vertical), or (Time, press_level) for gridded datasets, with the same
+    labels as the rows of `to_dataframe`
+
+    ds                  An xarray dataset stored as padded or gridded arrays
+    vars_to_keep        A list of variables to include in the dataframe
+    """
+    vert_dim = get_vert_dim(ds)
+    vert_vars = [var for var in vars_to_keep if vert_dim in ds[var].dims]
+    # Find which levels of each profile have any values
+    level_mask = np.full((ds.sizes['Time'], ds.sizes[vert_dim]), False)
+    for var in vert_vars:
+        level_mask |= ds[var].notnull().transpose('Time', vert_dim).values
+    n_levels = level_mask.sum(axis=1)
+    # Find the labels of the levels that were kept
+    levels = np.broadcast_to(ds[vert_dim].values, level_mask.shape)[level_mask]
+    index = pd.MultiIndex.from_arrays([np.repeat(ds['Time'].values, n_levels), levels], names=['Time', vert_dim])
+    columns = {}
+    for var in vars_to_keep:
+        if var in vert_vars:
+            columns[var] = ds[var].transpose('Time', vert_dim).values[level_mask]
+        else:
+            columns[var] = np.repeat(ds[var].values, n_levels)
+    return pd.DataFrame(columns, index=index, copy=False)
+
+def profiles_to_dataframe(ds, vars_to_keep, drop_padding=False, copy=True):
+    """
+    Returns a pandas dataframe of the given variables, for either padded or
+    ragged datasets. Ragged datasets with any variables along `obs` are
+    converted directly with `ragged_to_dataframe`
+
+    ds                  An xarray dataset
+    vars_to_keep        A list of variables to include in the dataframe
+    drop_padding        True/False whether to leave out the levels of padded
+                            datasets without any values, using
+                            `padded_to_dataframe`. False keeps every level so
+                            the columns can be reshaped back into the dataset
+    copy                True/False whether to copy the variables of ragged
+                            datasets, see `ragged_to_dataframe`
+    """
+    if is_ragged(ds) and any('obs' in ds[var].dims for var in vars_to_keep):
+        return ragged_to_dataframe(ds, vars_to_keep, copy=copy)
+    elif drop_padding and any(dim in ds[var].dims for var in vars_to_keep for dim in vert_dims):
+        return padded_to_dataframe(ds, vars_to_keep)
+    else:
+        return ds[vars_to_keep].to_dataframe()
+
+################################################################################
+# Define functions for subsampling profiles
+################################################################################
+# The sub-sample mask `ss_mask` is a boolean variable with the same dimensions
+#   as the vertical variables, True for the points to keep. The masks for all
+#   the profiles are found at once from a (Time, Vertical) array of the
+#   original vertical measure, which ragged datasets are padded into first
+
+def get_profile_array(ds, var):
+    """
+    Returns the values of the given vertical variable as an array with the
+    dimensions (Time, Vertical), or (Time, press_level) for gridded datasets,
+    after any other dimensions, like `ell`. Ragged datasets are padded with
+    NaNs to the length of the longest profile
+
+    ds                  An xarray dataset
+    var                 string of the name of the variable
+    """
+    if is_ragged(ds):
+        row_size = ds['row_size'].values
+        pf_ids, vert_idx = get_obs_position(row_size)
+        values = ds[var].transpose(..., 'obs').values
+        arr = np.full(values.shape[:-1]+(len(row_size), max(row_size.max(initial=0), 1)), np.nan)
+        arr[..., pf_ids, vert_idx] = values
+        return arr
+    else:
+        return ds[var].transpose(..., 'Time', get_vert_dim(ds)).values
+
+def get_obs_position(row_size):
+    """
+    Returns the index of the profile of each observation in a ragged dataset,
+    and the position of each observation within its profile
+
+    row_size            array of the number of observations in each profile
+    """
+    row_size = np.asarray(row_size, dtype='int64')
+    starts = np.cumsum(row_size) - row_size
+    pf_ids = np.repeat(np.arange(len(row_size)), row_size)
+    return pf_ids, np.arange(row_size.sum()) - starts[pf_ids]
+
+def ss_keep_every(vert_arr, n_pts):
+    """
+    Returns a boolean mask with the same shape as the given array which keeps
+    only every <n_pts> point of each profile, starting with the first
+
+    vert_arr            array of vertical values (pressure or depth) with the
+                            shape (Time, Vertical)
+    n_pts               An integer so that only every n_pts point is kept
+    """
+    return (np.arange(vert_arr.shape[-1]) % n_pts == 0) & ~np.isnan(vert_arr)
+
+def ss_spacing_pdf(vert_arr, spacings, probs=None, seed=0):
+    """
+    Returns a boolean mask with the same shape as the given array which keeps
+    only the points nearest to a series of vertical values in each profile,
+    starting from the top of each profile, with the spacings between them drawn
+    at random from the given probability distribution. This makes profiles
+    with the resolution of another instrument, like those of AIDJEX
+
+    vert_arr            array of vertical values (pressure or depth) with the
+                            shape (Time, Vertical)
+    spacings            list of the possible spacings between kept points, in
+                            the same units as vert_arr
+    probs               list of the probability of each spacing, or None for
+                            them all to be equally likely
+    seed                integer seed of the random number generator, so that
+                            the same mask is made every time
+    """
+    mask = np.full(vert_arr.shape, False)
+    order, is_value, starts, n_values, shifts, keys = stack_profiles(vert_arr)
+    if len(keys) == 0:
+        return mask
+    ends = starts + n_values - 1
+    has_values = n_values > 0
+    v_first = keys[starts[has_values]] - shifts[has_values]
+    v_last  = keys[ends[has_values]] - shifts[has_values]
+    # Draw spacings until there are enough to cover every profile
+    spacings = np.asarray(spacings, dtype='float64')
+    if isinstance(probs, type(None)):
+        mean_spacing = np.mean(spacings)
+    else:
+        mean_spacing = np.sum(spacings*np.asarray(probs))
+    n_draws = int(np.ceil(1.5*np.max(v_last - v_first)/mean_spacing)) + 1
+    rng = np.random.default_rng(seed)
+    draws = rng.choice(spacings, size=(len(v_first), n_draws), p=probs)
+    while np.any(np.sum(draws[:,1:], axis=1) < v_last - v_first):
+        draws = np.concatenate([draws, rng.choice(spacings, size=(len(v_first), n_draws), p=probs)], axis=1)
+    targets = v_first[:,np.newaxis] + np.cumsum(draws, axis=1) - draws[:,:1]
+    targets[targets > v_last[:,np.newaxis]] = np.nan
+    # Find the nearest point to each target within its profile
+    rows, cols = np.nonzero(~np.isnan(targets))
+    pf_rows = np.flatnonzero(has_values)[rows]
+    these_keys = targets[rows, cols] + shifts[pf_rows]
+    i1 = np.clip(np.searchsorted(keys, these_keys), starts[pf_rows], ends[pf_rows])
+    i0 = np.maximum(i1-1, starts[pf_rows])
+    nearest = np.where(np.abs(keys[i0]-these_keys) <= np.abs(keys[i1]-these_keys), i0, i1)
+    # Convert back to the original positions of the points in each profile
+    mask[pf_rows, order[pf_rows, nearest-starts[pf_rows]]] = True
+    return mask
+
+def find_spacing_pdf(ds, vert_var, decimals=1):
+    """
+    Returns the distinct spacings between consecutive measurements within the
+    profiles of the given dataset, and the fraction of all the spacings which
+    each of them makes up, to pass to `ss_spacing_pdf` to subsample other
+    profiles to the same resolution
+
+    ds                  An xarray dataset, padded or ragged
+    vert_var            string of the vertical variable, ex: 'press' or 'depth'
+    decimals            integer number of decimal places to round the spacings
+                            to, so that nearly equal spacings are counted together
+    """
+    d_vert = np.abs(np.diff(get_profile_array(ds, vert_var), axis=-1))
+    d_vert = np.round(d_vert[~np.isnan(d_vert)], decimals)
+    # Repeated measurements at the same level aren't spacings
+    d_vert = d_vert[d_vert > 0]
+    spacings, counts = np.unique(d_vert, return_counts=True)
+    return spacings, counts/np.sum(counts)
+
+def grid_dataset(ds, press_grid):
+    """
+    Returns a copy of the given padded or ragged dataset with all the profiles
+    linearly interpolated onto a uniform pressure grid along `press_level`,
+    all at once. The per-profile variables are kept as they are. Variables that
+    can't be interpolated, like cluster labels, are left as NaN
+
+    ds                  An xarray dataset
+    press_grid          float of the spacing of the grid in dbar
+    """
+    vert_dim = get_vert_dim(ds)
+    press_arr = get_profile_array(ds, 'press')
+    # Find which variables to interpolate
+    vert_vars = [var for var in ds.data_vars if vert_dim in ds[var].dims]
+    interp_vars = [var for var in vert_vars if var not in ['press', 'ss_mask', 'cluster', 'clst_prob'] and ds[var].dtype.kind == 'f']
+    # Interpolate each variable, and each slice along any other dimensions
+    list_of_arrs = []
+    for var in interp_vars:
+        arr = get_profile_array(ds, var)
+        list_of_arrs += list(arr.reshape((-1,)+press_arr.shape))
+    press_levels, gridded_press, gridded_arrs = grid_profiles(press_arr, list_of_arrs, press_grid)
+    # Make a new dataset with the per-profile variables
+    new_ds = ds.drop_vars(vert_vars+['row_size', 'Vertical'], errors='ignore')
+    new_ds = new_ds.assign_coords(press_level=('press_level', press_levels, {
+                            'units':'dbar',
+                            'label':'Pressure level (dbar)',
+                            'long_name':'Pressure of this level of the uniform grid'
+                        }))
+    new_ds['press'] = (['Time', 'press_level'], gridded_press, ds['press'].attrs)
+    k = 0
+    for var in interp_vars:
+        other_dims = [dim for dim in ds[var].dims if dim not in ['Time', vert_dim]]
+        n_slices = int(np.prod([ds.sizes[dim] for dim in other_dims]))
+        arr = np.stack(gridded_arrs[k:k+n_slices]).reshape(tuple(ds.sizes[dim] for dim in other_dims)+gridded_press.shape)
+        new_ds[var] = (other_dims+['Time', 'press_level'], arr, ds[var].attrs)
+        k += n_slices
+    # The other variables can't be interpolated
+    for var in vert_vars:
+        if var not in new_ds.data_vars:
+            new_ds[var] = (['Time', 'press_level'], np.full(gridded_press.shape, np.nan), ds[var].attrs)
+        #
+    new_ds.attrs['Pressure grid spacing'] = str(press_grid)+' dbar'
+    return add_zone_maps(new_ds)
+
+################################################################################
+# Define functions for skipping data outside of given ranges
+################################################################################
+# Each dataset stores a "zone map" of the minimum and maximum value of several
+#   vertical variables in each profile, in `zone_min` and `zone_max` along the
+#   `zone_var` dimension. These can be checked before reading any vertical data
+#   to skip the profiles which have no values in a given range
+
+# The variables for which to store the per-profile minimums and maximums
+zone_vars = ['press', 'depth', 'iT', 'CT', 'PT', 'SP', 'SA']
+# The names of the possible vertical dimensions
+vert_dims = ['Vertical', 'press_level', 'obs']
+
+def add_zone_maps(ds):
+    """
+    Returns the given dataset with the per-profile minimums and maximums of the
+    variables in `zone_vars` added as `zone_min` and `zone_max`
+
+    ds                  An xarray dataset, padded, gridded, or ragged
+    """
+    these_vars = [var for var in zone_vars if var in ds.data_vars]
+    n_pfs = ds.sizes['Time']
+    zone_min = np.full((n_pfs, len(these_vars)), np.nan)
+    zone_max = np.full((n_pfs, len(these_vars)), np.nan)
+    if is_ragged(ds):
+        row_size = ds['row_size'].values
+        starts = np.cumsum(row_size) - row_size
+        has_obs = row_size > 0
+    for j in range(len(these_vars)):
+        values = ds[these_vars[j]].values
+        # Use infinities in place of NaNs so they never count as the min or max
+        if is_ragged(ds):
+            if not has_obs.any():
+                continue
+            zone_min[has_obs,j] = np.minimum.reduceat(np.where(np.isnan(values), np.inf, values), starts[has_obs])
+            zone_max[has_obs,j] = np.maximum.reduceat(np.where(np.isnan(values), -np.inf, values), starts[has_obs])
+        else:
+            values = ds[these_vars[j]].transpose('Time', ...).values
+            zone_min[:,j] = np.min(np.where(np.isnan(values), np.inf, values), axis=1, initial=np.inf)
+            zone_max[:,j] = np.max(np.where(np.isnan(values), -np.inf, values), axis=1, initial=-np.inf)
+        #
+    # Profiles without any values get NaNs
+    zone_min[np.isinf(zone_min)] = np.nan
+    zone_max[np.isinf(zone_max)] = np.nan
+    ds = ds.drop_vars(['zone_min', 'zone_max', 'zone_var'], errors='ignore')
+    ds = ds.assign_coords(zone_var=('zone_var', these_vars))
+    ds['zone_min'] = (['Time', 'zone_var'], zone_min, {
+                            'units':'N/A',
+                            'label':'Profile minimum',
+                            'long_name':'Minimum value of each variable in zone_var in this profile'
+                        })
+    ds['zone_max'] = (['Time', 'zone_var'], zone_max, {
+                            'units':'N/A',
+                            'label':'Profile maximum',
+                            'long_name':'Maximum value of each variable in zone_var in this profile'
+                        })
+    return ds
+
+def zone_mask(ds, var, var_range):
+    """
+    Returns a boolean array along `Time` of which profiles might have values
+    of the given variable within the given range, based on the zone maps. If
+    the dataset doesn't have a zone map for the variable, all are True
+
+    ds                  An xarray dataset
+    var                 string of the name of the variable
+    var_range           [min, max] of the range of values
+    """
+    if 'zone_min' not in ds.data_vars or var not in ds['zone_var'].values:
+        return np.full(ds.sizes['Time'], True)
+    v_min = min(var_range)
+    v_max = max(var_range)
+    this_min = ds['zone_min'].sel(zone_var=var).values
+    this_max = ds['zone_max'].sel(zone_var=var).values
+    # The ranges are exclusive, matching how the profile filters are applied
+    return (this_max > v_min) & (this_min < v_max)
+
+def get_vert_dim(ds):
+    """
+    Returns the name of the vertical dimension of the given dataset
+
+    ds                  An xarray dataset
+    """
+    for dim in vert_dims:
+        if dim in ds.dims:
+            return dim
+
+def select_levels(ds, level_mask):
+    """
+    Returns the given dataset with only the vertical levels where the mask is
+    True. For padded and gridded datasets, this is one contiguous slice along
+    the vertical dimension covering every True value in any profile, so it can
+    be read as a block. For ragged datasets, only the observations where the
+    mask is True are kept, and `row_size` is updated to match
+
+    ds                  An xarray dataset
+    level_mask          boolean array with the shape of the vertical variables,
+                            or of just the vertical dimension
+    """
+    vert_dim = get_vert_dim(ds)
+    level_mask = np.asarray(level_mask)
+    if vert_dim == 'obs':
+        # Count how many observations are left in each profile
+        row_size = ds['row_size'].values
+        pf_ids = np.repeat(np.arange(ds.sizes['Time']), row_size)
+        new_sizes = np.bincount(pf_ids[level_mask], minlength=ds.sizes['Time'])
+        # Keep the original position of each observation within its profile so
+        #   the dataframes still line up with those of the whole dataset
+        if 'Vertical' not in ds.coords:
+            starts = np.cumsum(row_size) - row_size
+            ds = ds.assign_coords(Vertical=('obs', np.arange(row_size.sum()) - np.repeat(starts, row_size)))
+        ds = ds.isel(obs=np.flatnonzero(level_mask))
+        ds['row_size'] = ds['row_size'].copy(data=new_sizes)
+        return ds
+    if level_mask.ndim > 1:
+        level_mask = level_mask.any(axis=0)
+    keep_levels = np.flatnonzero(level_mask)
+    if len(keep_levels) == 0:
+        return ds.isel({vert_dim:slice(0, 0)})
+    return ds.isel({vert_dim:slice(keep_levels[0], keep_levels[-1]+1)})
@@ -39,8 +39,17 @@ import xarray as xr
 from datetime import datetime
 # For searching and listing directories
 import os
+# For keeping track of which data files have changed
+import json
+import hashlib
+# For reading in the data files and building the netcdfs in parallel
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# For timing how long each netcdf takes to build
+import time
+from itertools import repeat
 # For reading the ITP `cormat` files
-import mat73
+#   MATLAB v7.3 files are HDF5 files, older versions can be read with scipy
+import h5py
 from scipy import io
 # For reading netcdf files
 import netCDF4 as netcdf
@@ -49,6 +58,8 @@ import re
 # Import the Thermodynamic Equation of Seawater 2010 (TEOS-10) from GSW
 # For converting from depth to pressure
 import gsw
+# For the encodings to use when writing netcdfs
+import data_helper_functions as dhf
 
 # For test plots
 import matplotlib.pyplot as plt
@@ -83,14 +94,56 @@ def list_data_files(file_path):
 
 ################################################################################
 
-def make_all_ITP_netcdfs(science_data_file_path, format='cormat'):
+def make_all_ITP_netcdfs(science_data_file_path, format='cormat', n_workers=1, append=False, pfs_per_chunk=None, manifest_file='netcdfs/manifest.json', storage='padded', n_instrmt_workers=1, press_grid=None, backend='netcdf'):
     """
-    Finds ITP data files for all instruments available and formats them into netcdfs
+    Finds ITP data files for all instruments available and formats them into
+    netcdfs, building several instruments at once if n_instrmt_workers > 1
+    An instrument that fails to build is reported and recorded in the manifest
+    without stopping the others. Because the manifest is saved as each
+    instrument finishes, running this again after an interruption skips the
+    instruments which were already built and retries the ones that failed
+    Returns a dictionary of the result of building each netcdf (see
+    `build_ITP_netcdf`)
 
     science_data_file_path      string of the filepath where the data is stored
     format                      which version of the data files to use
                                     either 'cormat' or 'final'
+    n_workers                   integer number of processes to use when reading
+                                    the data files of each instrument
+    append                      True/False whether to only add new profiles to
+                                    the netcdfs which already exist
+    pfs_per_chunk               integer number of profiles for which to calculate
+                                    the TEOS-10 variables at once, None for all
+    manifest_file               string of the file path of the manifest which
+                                    records the data files already read in, so
+                                    that only new or modified files get read.
+                                    None to read in all files of all ITPs
+    storage                     string of how to store the vertical data, either
+                                    'padded' or 'ragged' (see read_instrmt)
+    n_instrmt_workers           integer number of instruments to build at once,
+                                    each in its own process. Note: up to
+                                    n_instrmt_workers*n_workers processes are
+                                    used in total
+    press_grid                  float of the spacing in dbar of a uniform
+                                    pressure grid for the profiles, or None
+                                    (see read_instrmt)
+    backend                     string of how to store the datasets, either
+                                    'netcdf' for .nc files or 'zarr' for .zarr
+                                    directory stores
     """
+    # Find the file extension for the chosen backend
+    if backend == 'netcdf':
+        out_ext = '.nc'
+    elif backend == 'zarr':
+        out_ext = '.zarr'
+    else:
+        print(backend,'is not a valid backend')
+        exit(0)
+    # Load the record of which data files have already been read in
+    if not isinstance(manifest_file, type(None)):
+        manifest = load_manifest(manifest_file)
+    else:
+        manifest = None
     # Declare file path
     main_dir = science_data_file_path+'ITPs/'
     # Search the provided file path
@@ -101,29 +154,273 @@ def make_all_ITP_netcdfs(science_data_file_path, format='cormat'):
     else:
         print(main_dir, " is not a directory")
         exit(0)
-    # Read in data for all ITPs available
-    for itp in ITP_dirs:
+    # Make the list of arguments to build each instrument's netcdf
+    list_of_args = []
+    for itp in sorted(ITP_dirs):
         # Get just the number for the itp
         itp_number = ''.join(filter(str.isdigit, itp))
-        read_instrmt('ITP', itp_number, main_dir+itp+'/'+itp+format, 'netcdfs/ITP_'+itp_number.zfill(3)+'.nc')
+        instrmt_dir = main_dir+itp+'/'+itp+format
+        out_file = 'netcdfs/ITP_'+itp_number.zfill(3)+out_ext
+        # Find the entries for this instrument recorded in the manifest
+        if isinstance(manifest, type(None)):
+            old_entry = None
+        elif out_file in manifest.keys():
+            old_entry = manifest[out_file]
+        else:
+            old_entry = {'files':{}}
+        list_of_args.append((itp_number, instrmt_dir, out_file, old_entry, n_workers, append, pfs_per_chunk, storage, press_grid))
+    print('Building',len(list_of_args),'ITP netcdfs with',n_instrmt_workers,'instrument workers')
+    start_time = time.perf_counter()
+    results = {}
+    if n_instrmt_workers > 1 and len(list_of_args) > 1:
+        with ProcessPoolExecutor(max_workers=n_instrmt_workers) as executor:
+            futures = [executor.submit(build_ITP_netcdf, *args) for args in list_of_args]
+            # Handle each instrument as soon as it finishes, in whatever order
+            for future in as_completed(futures):
+                result = future.result()
+                record_build_result(result, results, manifest, manifest_file, len(list_of_args))
+    else:
+        for args in list_of_args:
+            result = build_ITP_netcdf(*args)
+            record_build_result(result, results, manifest, manifest_file, len(list_of_args))
+    # Summarize the run
+    failed = [out_file for out_file in results.keys() if results[out_file]['status'] == 'failed']
+    print('Finished',len(results),'ITP netcdfs in',round(time.perf_counter()-start_time, 1),'s,',len(failed),'failed')
+    for out_file in failed:
+        print('\t',out_file,'failed:',results[out_file]['error'])
+    return results
+
+def build_ITP_netcdf(itp_number, instrmt_dir, out_file, old_entry, n_workers=1, append=False, pfs_per_chunk=None, storage='padded', press_grid=None):
+    """
+    Builds or updates the netcdf of one ITP, catching any errors so that one bad
+    instrument can't stop the others. Can be run in a separate process
+    Returns a dictionary with the keys:
+        'out_file'  the file path of the netcdf
+        'status'    one of 'built', 'appended', 'unchanged', 'missing', 'failed'
+        'time'      the number of seconds it took
+        'error'     a string of the error if it failed, otherwise None
+        'entry'     the new manifest entry for this instrument, or None to leave
+                        the manifest as is
+
+    itp_number          string of the number of the ITP
+    instrmt_dir         string of a file path to this instrmt's directory
+    out_file            string of the file path in which to save the netcdf,
+                            or zarr store if it ends in '.zarr'
+    old_entry           dictionary of the manifest entry for this instrmt, with
+                            at least the key 'files', or None to not use a
+                            manifest and read all the files
+    n_workers           integer number of processes to use when reading the data files
+    append              True/False whether to only add new profiles to the netcdf
+                            (only used when not using a manifest)
+    pfs_per_chunk       integer number of profiles for which to calculate the
+                            TEOS-10 variables at once, None for all
+    storage             string of how to store the vertical data, either
+                            'padded' or 'ragged' (see read_instrmt)
+    press_grid          float of the spacing in dbar of a uniform pressure grid
+                            for the profiles, or None (see read_instrmt)
+    """
+    start_time = time.perf_counter()
+    result = {'out_file':out_file, 'status':None, 'time':None, 'error':None, 'entry':None}
+    try:
+        if isinstance(old_entry, type(None)):
+            read_instrmt('ITP', itp_number, instrmt_dir, out_file, n_workers=n_workers, append=append, pfs_per_chunk=pfs_per_chunk, storage=storage, press_grid=press_grid)
+            result['status'] = 'built'
+        else:
+            # Compare the data files to the ones recorded in the manifest
+            file_entries, changed_files, removed_files = find_changed_files(instrmt_dir, old_entry['files'])
+            if isinstance(file_entries, type(None)):
+                print('Did not find any files for ITP',itp_number)
+                result['status'] = 'missing'
+            elif os.path.exists(out_file) and len(changed_files) == 0 and len(removed_files) == 0 and 'error' not in old_entry.keys():
+                print('No changes to the data files for ITP',itp_number)
+                result['status'] = 'unchanged'
+            else:
+                # Only read in the new or modified files, unless some files were
+                #   removed or the last build failed, in which case the netcdf
+                #   needs to be made from scratch
+                if os.path.exists(out_file) and len(removed_files) == 0 and 'error' not in old_entry.keys():
+                    print('Found',len(changed_files),'new or modified files for ITP',itp_number)
+                    file_pf_nos = read_instrmt('ITP', itp_number, instrmt_dir, out_file, n_workers=n_workers, append=True, pfs_per_chunk=pfs_per_chunk, data_files=changed_files, storage=storage, press_grid=press_grid)
+                    result['status'] = 'appended'
+                else:
+                    file_pf_nos = read_instrmt('ITP', itp_number, instrmt_dir, out_file, n_workers=n_workers, pfs_per_chunk=pfs_per_chunk, storage=storage, press_grid=press_grid)
+                    result['status'] = 'built'
+                # Record which profile each file produced
+                for file in file_pf_nos.keys():
+                    file_entries[file]['prof_no'] = file_pf_nos[file]
+                result['entry'] = {'instrmt_dir':instrmt_dir, 'files':file_entries}
+            #
+        #
+    # `read_instrmt` calls exit() on some errors, which raises SystemExit
+    except (Exception, SystemExit) as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+        # Keep the previous file entries, but note the failure so the next run
+        #   rebuilds this netcdf from scratch
+        if not isinstance(old_entry, type(None)):
+            result['entry'] = dict(old_entry, instrmt_dir=instrmt_dir, error=result['error'])
+    result['time'] = time.perf_counter() - start_time
+    return result
+
+def record_build_result(result, results, manifest, manifest_file, n_instrmts):
+    """
+    Reports the result of building one netcdf, adds it to the dictionary of
+    results, and saves it to the manifest so the run can be resumed
+
+    result              dictionary returned by `build_ITP_netcdf`
+    results             dictionary of results so far, keyed by out_file
+    manifest            dictionary of the manifest, or None if not using one
+    manifest_file       string of the file path of the manifest
+    n_instrmts          integer total number of instruments being built
+    """
+    results[result['out_file']] = result
+    print('['+str(len(results))+'/'+str(n_instrmts)+']',result['out_file'],result['status'],'in',round(result['time'], 1),'s')
+    if result['status'] == 'failed':
+        print('\t',result['error'])
+    # Save after each instrument in case the run gets interrupted
+    if not isinstance(manifest, type(None)) and not isinstance(result['entry'], type(None)):
+        manifest[result['out_file']] = result['entry']
+        save_manifest(manifest, manifest_file)
     #
 
 ################################################################################
 
-def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
+def load_manifest(manifest_file):
+    """
+    Returns the dictionary stored in the manifest file, or an empty dictionary
+    if the file doesn't exist yet. The manifest has the following format:
+    {out_file: {'instrmt_dir':instrmt_dir, 'files':{file_name:file_entry}}}
+    where each file_entry is a dictionary with the keys 'path', 'size',
+    'mtime', 'hash', and 'prof_no' (None if the file didn't produce a profile)
+    If the last attempt to build out_file failed, its entry also has an 'error'
+
+    manifest_file       string of the file path of the manifest
+    """
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    else:
+        return {}
+
+def save_manifest(manifest, manifest_file):
+    """
+    Writes out the manifest dictionary to the manifest file
+
+    manifest            dictionary in the format described in `load_manifest`
+    manifest_file       string of the file path of the manifest
+    """
+    # Write to a temporary file first so an interruption can't corrupt the manifest
+    temp_file = manifest_file+'.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_file, manifest_file)
+
+def hash_file(file_path):
+    """
+    Returns a string of the SHA-1 hash of the contents of the given file
+
+    file_path           string of the file path of the file to hash
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def find_changed_files(instrmt_dir, old_entries):
+    """
+    Compares the data files in an instrmt's directory to the entries recorded
+    in the manifest. Files with the same size and modification time are assumed
+    to be unchanged, otherwise the hash of the contents is compared
+    Returns a dictionary of the current file entries (with the profile numbers
+    carried over for the unchanged files), a list of new or modified files, and
+    a list of files which were removed. Returns None for all three if the
+    directory doesn't exist
+
+    instrmt_dir         string of a file path to this instrmt's directory
+    old_entries         dictionary of file entries for this instrmt from the manifest
+    """
+    data_files = list_data_files(instrmt_dir)
+    if isinstance(data_files, type(None)):
+        return None, None, None
+    file_entries = {}
+    changed_files = []
+    for file in data_files:
+        file_path = instrmt_dir+'/'+file
+        if not os.path.isfile(file_path):
+            continue
+        stat = os.stat(file_path)
+        new_entry = {'path':file_path, 'size':stat.st_size, 'mtime':stat.st_mtime, 'hash':None, 'prof_no':None}
+        if file in old_entries.keys():
+            old_entry = old_entries[file]
+            # Only hash the file if it looks like it might have changed
+            if old_entry['size'] == new_entry['size'] and old_entry['mtime'] == new_entry['mtime']:
+                new_entry['hash'] = old_entry['hash']
+            else:
+                new_entry['hash'] = hash_file(file_path)
+            if new_entry['hash'] == old_entry['hash']:
+                new_entry['prof_no'] = old_entry['prof_no']
+            else:
+                changed_files.append(file)
+        else:
+            new_entry['hash'] = hash_file(file_path)
+            changed_files.append(file)
+        file_entries[file] = new_entry
+    removed_files = [file for file in old_entries.keys() if file not in file_entries.keys()]
+    return file_entries, changed_files, removed_files
+
+################################################################################
+
+def read_instrmt(source, instrmt_name, instrmt_dir, out_file, n_workers=1, vert_dtype='float64', append=False, pfs_per_chunk=None, data_files=None, storage='padded', press_grid=None):
     """
     Reads in all the data for the specified instrument and formats it into a
     single netcdf
+    Returns a dictionary of the profile number produced by each data file read,
+    (None for files that didn't produce a profile)
 
     source              string of the name of the data source (ex: 'AIDJEX', 'ITP')
     instrmt_name        string of the name of this instrmt
     instrmt_dir         string of a file path to this instrmt's directory
-    out_file            string of the file path in which to save the netcdf
+    out_file            string of the file path in which to save the netcdf,
+                            or zarr store if it ends in '.zarr'
+    n_workers           integer number of processes to use when reading in the
+                            data files, 1 reads them one at a time
+    vert_dtype          string of the float dtype in which to store the vertical
+                            data, either 'float64' or 'float32'
+    append              True/False whether to only read the profiles which are not
+                            already in `out_file` and add them to the end of it.
+                            New profiles are appended along `Time` in place if
+                            they fit the layout of the file (see
+                            `dhf.append_profiles`), otherwise the whole file is
+                            read in and rewritten, as it is when any profiles
+                            are replaced. If `out_file` doesn't exist yet, it
+                            is created as usual
+    pfs_per_chunk       integer number of profiles for which to calculate the
+                            TEOS-10 variables at once to limit the memory used,
+                            None to calculate them for all profiles at once
+    data_files          list of the names of the data files to read, None to read
+                            all the files in instrmt_dir. When appending, any
+                            profiles in `out_file` with the same profile numbers
+                            as these files are replaced
+    storage             string of how to store the vertical data, either 'padded'
+                            to pad every profile with NaNs to the length of the
+                            longest along `Vertical`, or 'ragged' to store the
+                            profiles one after another along `obs` as a CF
+                            contiguous ragged array with a `row_size` for each
+                            profile. When appending, the existing file's
+                            storage is used
+    press_grid          float of the spacing in dbar of a uniform pressure grid
+                            onto which to interpolate all the profiles, stored
+                            along a `press_level` dimension instead of
+                            `Vertical`, or None to keep the measured pressures.
+                            Can't be used with ragged storage. When appending,
+                            the existing file's grid is used
     """
     print('Reading',source,instrmt_name)
     # Select the corresponding read function for the provided data source
     if source == 'ITP':
         read_data_file  = read_ITP_data_file
+        find_prof_no    = find_ITP_prof_no
         attribution    = 'The Ice-Tethered Profiler data were collected and made available by the Ice-Tethered Profiler Program (Toole et al., 2011; Krishfield et al., 2008) based at the Woods Hole Oceanographic Institution'
         source_url      = 'https://www.whoi.edu/itp'
         og_vert         = 'press'
@@ -132,6 +429,12 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
     else:
         print(source,'is not a valid source')
         exit(0)
+    if storage not in ['padded', 'ragged']:
+        print(storage,'is not a valid storage option')
+        exit(0)
+    if storage == 'ragged' and not isinstance(press_grid, type(None)):
+        print('Cannot store profiles on a pressure grid as ragged arrays')
+        exit(0)
     # Make blank arrays for data
     list_of_entries         = []
     list_of_pf_nos          = []
@@ -140,68 +443,106 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
     list_of_datetimes_end   = []
     list_of_lons            = []
     list_of_lats            = []
-    list_of_regs            = []
     list_of_up_casts        = []
     list_of_press_arrs      = []
-    list_of_depth_arrs      = []
     list_of_iT_arrs         = []
-    list_of_CT_arrs         = []
-    list_of_PT_arrs         = []
     list_of_SP_arrs         = []
-    list_of_SA_arrs         = []
     # Keep track of the maximum number of vertical measurements per profile
     max_vert_count = 0
+    # Check whether to add new profiles to an existing netcdf
+    if append and os.path.exists(out_file):
+        # Only the per-profile variables of the existing file are read for now,
+        #   then it's closed so that it can be written to
+        ds_old = dhf.open_dataset(out_file)
+        ds_old.close()
+        # Keep the new profiles in the same storage as the existing ones
+        if dhf.is_ragged(ds_old):
+            storage = 'ragged'
+        else:
+            storage = 'padded'
+        # Put the new profiles on the same pressure grid as the existing ones
+        if dhf.is_gridded(ds_old):
+            press_grid = dhf.get_vert_res(ds_old)
+        else:
+            press_grid = None
+        # Keep track of the entry number of each existing profile
+        old_entries = dict(zip(ds_old['prof_no'].values, ds_old['entry'].values))
+        # Start the new entry numbers after the existing ones
+        if len(old_entries) > 0:
+            first_entry = int(ds_old['entry'].values.max()) + 1
+        else:
+            first_entry = 0
+        print('Found',len(old_entries),'existing profiles in',out_file)
+    else:
+        ds_old = None
+        first_entry = 0
     # Loop through the data files in this instrmt's directory
-    data_files = list_data_files(instrmt_dir)
     if isinstance(data_files, type(None)):
-        print('Did not find any files for',instrmt_name)
-        exit(0)
-    else:
-        # Keep track of the entry number with i
-        i = 0
-        for file in data_files:
-            if os.path.isfile(instrmt_dir+'/'+file):
-                # Read in the data file for this profile
-                out_dict = read_data_file(instrmt_dir, file, instrmt_name)
-                if not isinstance(out_dict, type(None)):
-                    # Append that data
-                    list_of_entries.append(i)
-                    list_of_pf_nos.append(out_dict['prof_no'])
-                    list_of_black_list.append(out_dict['black_list'])
-                    list_of_datetimes_start.append(out_dict['dt_start'])
-                    list_of_datetimes_end.append(out_dict['dt_end'])
-                    list_of_lons.append(out_dict['lon'])
-                    list_of_lats.append(out_dict['lat'])
-                    list_of_regs.append(out_dict['region'])
-                    list_of_up_casts.append(out_dict['up_cast'])
-                    list_of_press_arrs.append(out_dict['press'])
-                    list_of_depth_arrs.append(out_dict['depth'])
-                    list_of_iT_arrs.append(out_dict['iT'])
-                    list_of_CT_arrs.append(out_dict['CT'])
-                    list_of_PT_arrs.append(out_dict['PT'])
-                    list_of_SP_arrs.append(out_dict['SP'])
-                    list_of_SA_arrs.append(out_dict['SA'])
-                    # Check for a new maximum vertical dimension length
-                    max_vert_count = max(max_vert_count, len(out_dict['depth']))
-                    # Increase entry number
-                    i += 1
-                #
-            #
+        data_files = list_data_files(instrmt_dir)
+        if isinstance(data_files, type(None)):
+            print('Did not find any files for',instrmt_name)
+            exit(0)
+        # Only read the actual files, not any sub-directories
+        data_files = [file for file in data_files if os.path.isfile(instrmt_dir+'/'+file)]
+        # Only read the files of profiles which aren't in the existing netcdf
+        if not isinstance(ds_old, type(None)):
+            data_files = [file for file in data_files if find_prof_no(file) not in old_entries.keys()]
+    if not isinstance(ds_old, type(None)):
+        if len(data_files) == 0:
+            print('No new profiles to add to',out_file)
+            return {}
+        # Find the existing profiles which are about to be read in again
+        replaced_pf_nos = [find_prof_no(file) for file in data_files if find_prof_no(file) in old_entries.keys()]
+    # Read in the data file for each profile
+    out_dicts = read_data_files(read_data_file, instrmt_dir, data_files, instrmt_name, n_workers)
+    # Keep track of which profile each file produced
+    file_pf_nos = {}
+    # Keep track of the entry number with i
+    i = first_entry
+    for file, out_dict in zip(data_files, out_dicts):
+        if isinstance(out_dict, type(None)):
+            file_pf_nos[file] = None
+        else:
+            file_pf_nos[file] = int(out_dict['prof_no'])
+            # Append that data, keeping the same entry number for replaced profiles
+            if not isinstance(ds_old, type(None)) and out_dict['prof_no'] in old_entries.keys():
+                list_of_entries.append(old_entries[out_dict['prof_no']])
+            else:
+                list_of_entries.append(i)
+                # Increase entry number
+                i += 1
+            list_of_pf_nos.append(out_dict['prof_no'])
+            list_of_black_list.append(out_dict['black_list'])
+            list_of_datetimes_start.append(out_dict['dt_start'])
+            list_of_datetimes_end.append(out_dict['dt_end'])
+            list_of_lons.append(out_dict['lon'])
+            list_of_lats.append(out_dict['lat'])
+            list_of_up_casts.append(out_dict['up_cast'])
+            list_of_press_arrs.append(out_dict['press'])
+            list_of_iT_arrs.append(out_dict['iT'])
+            list_of_SP_arrs.append(out_dict['SP'])
+            # Check for a new maximum vertical dimension length
+            max_vert_count = max(max_vert_count, len(out_dict['press']))
         #
     #
-    # Make sure the vertical data are all the same length lists
-    for i in range(len(list_of_depth_arrs)):
-        list_of_press_arrs[i] = list(list_of_press_arrs[i]) +[None]*(max_vert_count - len(list_of_press_arrs[i]))
-        list_of_depth_arrs[i] = list(list_of_depth_arrs[i]) +[None]*(max_vert_count - len(list_of_depth_arrs[i]))
-        list_of_iT_arrs[i] = list(list_of_iT_arrs[i]) + [None]*(max_vert_count - len(list_of_iT_arrs[i]))
-        list_of_SP_arrs[i] = list(list_of_SP_arrs[i]) + [None]*(max_vert_count - len(list_of_SP_arrs[i]))
-        list_of_CT_arrs[i] = list(list_of_CT_arrs[i]) + [None]*(max_vert_count - len(list_of_CT_arrs[i]))
-        list_of_PT_arrs[i] = list(list_of_PT_arrs[i]) + [None]*(max_vert_count - len(list_of_PT_arrs[i]))
-        list_of_SA_arrs[i] = list(list_of_SA_arrs[i]) + [None]*(max_vert_count - len(list_of_SA_arrs[i]))
-    #
+    # Pack the vertical data into arrays of the same length, padded with NaNs
+    press_arr = pack_profiles(list_of_press_arrs, max_vert_count, vert_dtype)
+    iT_arr    = pack_profiles(list_of_iT_arrs, max_vert_count, vert_dtype)
+    SP_arr    = pack_profiles(list_of_SP_arrs, max_vert_count, vert_dtype)
+    # Keep track of the number of measurements in each profile
+    list_of_row_sizes = [len(arr) for arr in list_of_press_arrs]
+    # Free up the memory used by the per-profile arrays
+    del list_of_press_arrs, list_of_iT_arrs, list_of_SP_arrs
+    # Interpolate all the profiles onto the same pressure grid
+    if not isinstance(press_grid, type(None)) and len(list_of_entries) > 0:
+        print('Interpolating onto a',press_grid,'dbar pressure grid')
+        press_levels, press_arr, [iT_arr, SP_arr] = dhf.grid_profiles(press_arr, [iT_arr, SP_arr], press_grid, vert_dtype)
+        max_vert_count = len(press_levels)
+    # Calculate all the TEOS-10 variables at once
+    TEOS10_dict = calc_TEOS10_vars(press_arr, iT_arr, SP_arr, list_of_lons, list_of_lats, pfs_per_chunk, vert_dtype)
     # Make a blank array for each dimension
-    Time_blank = [None]*len(list_of_datetimes_start)
-    Vertical_blank = [[None]*max_vert_count]*len(list_of_datetimes_start)
+    Time_blank = np.full(len(list_of_datetimes_start), np.nan, dtype=vert_dtype)
+    Vertical_blank = np.full((len(list_of_datetimes_start), max_vert_count), np.nan, dtype=vert_dtype)
 
     # Define variables with data and attributes
     nc_vars = {
@@ -272,11 +613,13 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'region':(
                         ['Time'],
-                        list_of_regs,
+                        dhf.find_geo_regions(list_of_lons, list_of_lats),
                         {
                             'units':'N/A',
                             'label':'Geographical region',
-                            'long_name':'Geographical region in which this entry was measured'
+                            'long_name':'Geographical region in which this entry was measured',
+                            'flag_values':np.arange(-1, len(dhf.region_names), dtype='int8'),
+                            'flag_meanings':' '.join(['error']+dhf.region_names)
                         }
                 ),
                 'up_cast':(
@@ -299,7 +642,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'press':(
                         ['Time','Vertical'],
-                        list_of_press_arrs,
+                        press_arr,
                         {
                             'units':'dbar',
                             'label':'Pressure (dbar)',
@@ -308,7 +651,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'depth':(
                         ['Time','Vertical'],
-                        list_of_depth_arrs,
+                        TEOS10_dict['depth'],
                         {
                             'units':'m',
                             'label':'Depth (m)',
@@ -317,7 +660,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'iT':(
                         ['Time','Vertical'],
-                        list_of_iT_arrs,
+                        iT_arr,
                         {
                             'units':'degrees Celcius',
                             'label':'in-situ Temperature ($^\circ$C)',
@@ -326,7 +669,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'CT':(
                         ['Time','Vertical'],
-                        list_of_CT_arrs,
+                        TEOS10_dict['CT'],
                         {
                             'units':'degrees Celcius',
                             'label':'$\Theta$ ($^\circ$C)',
@@ -335,7 +678,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'PT':(
                         ['Time','Vertical'],
-                        list_of_PT_arrs,
+                        TEOS10_dict['PT'],
                         {
                             'units':'degrees Celcius',
                             'label':'$\theta$ ($^\circ$C)',
@@ -344,7 +687,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'SP':(
                         ['Time','Vertical'],
-                        list_of_SP_arrs,
+                        SP_arr,
                         {
                             'units':'g/kg',
                             'label':'$S_P$ (g/kg)',
@@ -353,7 +696,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'SA':(
                         ['Time','Vertical'],
-                        list_of_SA_arrs,
+                        TEOS10_dict['SA'],
                         {
                             'units':'g/kg',
                             'label':'$S_A$ (g/kg)',
@@ -362,7 +705,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'sigma':(
                         ['Time','Vertical'],
-                        gsw.sigma1(list_of_SA_arrs, list_of_CT_arrs),
+                        TEOS10_dict['sigma'],
                         {
                             'units':'kg/m^3',
                             'label':'$\\sigma_1$ (kg/m$^3$)',
@@ -371,7 +714,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'alpha':(
                         ['Time','Vertical'],
-                        gsw.alpha(list_of_SA_arrs, list_of_CT_arrs, list_of_press_arrs),
+                        TEOS10_dict['alpha'],
                         {
                             'units':'1/(degrees Celcius)',
                             'label':'$\\alpha$ (1/$^\circ$C)',
@@ -380,7 +723,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'alpha_PT':(
                         ['Time','Vertical'],
-                        gsw.alpha(list_of_SA_arrs, list_of_PT_arrs, list_of_press_arrs),
+                        TEOS10_dict['alpha_PT'],
                         {
                             'units':'1/(degrees Celcius)',
                             'label':'$\\alpha_{PT}$ (1/$^\circ$C)',
@@ -389,7 +732,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'alpha_iT':(
                         ['Time','Vertical'],
-                        gsw.alpha_wrt_t_exact(list_of_SA_arrs, list_of_iT_arrs, list_of_press_arrs),
+                        TEOS10_dict['alpha_iT'],
                         {
                             'units':'1/(degrees Celcius)',
                             'label':'$\\alpha_{iT}$ (1/$^\circ$C)',
@@ -398,7 +741,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'beta':(
                         ['Time','Vertical'],
-                        gsw.beta(list_of_SA_arrs, list_of_CT_arrs, list_of_press_arrs),
+                        TEOS10_dict['beta'],
                         {
                             'units':'1/(g/kg)',
                             'label':'$\\beta$ (kg/g)',
@@ -407,7 +750,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 ),
                 'beta_PT':(
                         ['Time','Vertical'],
-                        gsw.beta(list_of_SA_arrs, list_of_PT_arrs, list_of_press_arrs),
+                        TEOS10_dict['beta_PT'],
                         {
                             'units':'1/(g/kg)',
                             'label':'$\\beta_{PT}$ (kg/g)',
@@ -535,6 +878,7 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
                 'Original vertical measure':og_vert,
                 'Original temperature measure':og_temp,
                 'Original salinity measure':og_salt,
+                'Pressure grid spacing':'None',
                 'Sub-sample scheme':'None',
                 'Moving average window':'None',
                 'Last clustered':'Never',
@@ -547,9 +891,158 @@ def read_instrmt(source, instrmt_name, instrmt_dir, out_file):
 
     # Convert into a dataset
     ds = xr.Dataset(data_vars=nc_vars, coords=nc_coords, attrs=nc_attrs)
-    # Write out to netcdf
+    # Index the vertical dimension by the pressure levels of the grid
+    if not isinstance(press_grid, type(None)) and len(list_of_entries) > 0:
+        ds = ds.rename({'Vertical':'press_level'})
+        ds['press_level'] = ('press_level', press_levels, {
+                            'units':'dbar',
+                            'label':'Pressure level (dbar)',
+                            'long_name':'Pressure of this level of the uniform grid'
+                        })
+        ds.attrs['Pressure grid spacing'] = str(press_grid)+' dbar'
+    # Drop the padding to store the profiles as a contiguous ragged array
+    if storage == 'ragged':
+        ds = dhf.padded_to_ragged(ds, list_of_row_sizes)
+    # Find the minimum and maximum of the vertical variables in each profile so
+    #   that profiles can be skipped without reading their vertical data
+    ds = dhf.add_zone_maps(ds)
+    # Add the new profiles to the end of the existing ones
+    if not isinstance(ds_old, type(None)):
+        print('Adding',len(list_of_entries),'new or updated profiles to',out_file)
+        # Keep the global attributes of the existing file
+        new_attrs = dict(ds_old.attrs)
+        new_attrs['Last modified'] = str(datetime.now())
+        new_attrs['Last modification'] = 'Appended '+str(len(list_of_entries))+' new or updated profiles'
+        ds.attrs = new_attrs
+        # If no profiles are replaced, try to append the new ones in place,
+        #   without reading or rewriting the existing ones
+        if len(replaced_pf_nos) == 0 and dhf.append_profiles(ds, out_file):
+            print('Appended the new profiles to',out_file,'in place')
+            return file_pf_nos
+        # Otherwise, read in the whole existing file to rewrite it
+        print('Rewriting',out_file,'with the new profiles')
+        ds_old = dhf.load_dataset(out_file)
+        # Netcdfs made before the regions were stored as codes have strings
+        if ds_old['region'].dtype.kind not in 'iu':
+            ds_old['region'] = ds_old['region'].copy(data=dhf.find_geo_regions(ds_old['lon'].values, ds_old['lat'].values))
+        # Remove the existing profiles which were read in again
+        ds_old = dhf.select_profiles(ds_old, np.flatnonzero(~np.isin(ds_old['prof_no'].values, replaced_pf_nos)))
+        # For padded storage, the outer join on `Vertical` pads the shorter
+        #   profiles with NaNs, and the existing moving averages, clusters, etc.
+        #   are kept as is
+        #   The zone maps are found again for all the profiles
+        ds = dhf.concat_profiles([ds_old.drop_vars(['zone_min', 'zone_max', 'zone_var'], errors='ignore'), ds.drop_vars(['zone_min', 'zone_max', 'zone_var'])])
+        # Put any replaced profiles back in their original places
+        ds = dhf.select_profiles(ds, np.argsort(ds['entry'].values, kind='stable'))
+        ds = dhf.add_zone_maps(ds)
+        ds.attrs = new_attrs
+    # Write out to netcdf or zarr store
+    #   Note: the vertical variables are compressed and stored as float32
     print('Writing data to',out_file)
-    ds.to_netcdf(out_file, 'w')
+    dhf.write_dataset(ds, out_file)
+    return file_pf_nos
+
+################################################################################
+
+def pack_profiles(list_of_arrs, max_vert_count, vert_dtype='float64'):
+    """
+    Packs a list of 1D arrays of different lengths into one 2D array, filling in
+    the end of the shorter arrays with NaNs
+    Returns an array with the shape (len(list_of_arrs), max_vert_count)
+
+    list_of_arrs        list of the 1D arrays of vertical data, one per profile
+    max_vert_count      integer length of the longest array in the list
+    vert_dtype          string of the float dtype of the output array
+    """
+    # Make one array for all the profiles, already filled with NaNs
+    packed_arr = np.full((len(list_of_arrs), max_vert_count), np.nan, dtype=vert_dtype)
+    # Fill in each row with the data, leaving the NaNs at the end
+    for i in range(len(list_of_arrs)):
+        packed_arr[i, :len(list_of_arrs[i])] = list_of_arrs[i]
+    return packed_arr
+
+################################################################################
+
+def calc_TEOS10_vars(press_arr, iT_arr, SP_arr, lons, lats, pfs_per_chunk=None, vert_dtype='float64'):
+    """
+    Calculates the TEOS-10 variables for all the profiles of an instrument at once
+    Returns a dictionary of arrays with the same shape as `press_arr` for the
+    variables 'depth', 'SA', 'CT', 'PT', 'sigma', 'alpha', 'alpha_PT',
+    'alpha_iT', 'beta', and 'beta_PT'
+
+    press_arr           2D array of pressure, (Time, Vertical), padded with NaNs
+    iT_arr              2D array of in-situ temperature, same shape as press_arr
+    SP_arr              2D array of practical salinity, same shape as press_arr
+    lons                list of the longitude of each profile
+    lats                list of the latitude of each profile
+    pfs_per_chunk       integer number of profiles to calculate at once to limit
+                            the memory used, None to calculate all at once
+    vert_dtype          string of the float dtype of the output arrays
+    """
+    n_pfs, n_vert = press_arr.shape
+    # Make the output arrays, already filled with NaNs for the padding
+    TEOS10_vars = ['depth', 'SA', 'CT', 'PT', 'sigma', 'alpha', 'alpha_PT', 'alpha_iT', 'beta', 'beta_PT']
+    TEOS10_dict = {}
+    for var in TEOS10_vars:
+        TEOS10_dict[var] = np.full((n_pfs, n_vert), np.nan, dtype=vert_dtype)
+    if isinstance(pfs_per_chunk, type(None)):
+        pfs_per_chunk = max(n_pfs, 1)
+    # Make columns of the per-profile coordinates to broadcast across each profile
+    lon_col = np.array(lons, dtype='float64')[:, np.newaxis]
+    lat_col = np.array(lats, dtype='float64')[:, np.newaxis]
+    for i0 in range(0, n_pfs, pfs_per_chunk):
+        i1 = min(i0+pfs_per_chunk, n_pfs)
+        # Only calculate for the measured levels, skipping the NaN padding
+        not_pad = ~np.isnan(press_arr[i0:i1])
+        press = press_arr[i0:i1][not_pad]
+        iT    = iT_arr[i0:i1][not_pad]
+        SP    = SP_arr[i0:i1][not_pad]
+        lon   = np.broadcast_to(lon_col[i0:i1], not_pad.shape)[not_pad]
+        lat   = np.broadcast_to(lat_col[i0:i1], not_pad.shape)[not_pad]
+        # Convert to absolute salinity (SA), conservative (CT) and potential temperature (PT)
+        SA = gsw.SA_from_SP(SP, press, lon, lat)
+        CT = gsw.CT_from_t(SA, iT, press)
+        PT = gsw.pt0_from_t(SA, iT, press)
+        # Fill in the values for this chunk of profiles
+        #   Slicing the rows gives a view, so this fills the output arrays
+        TEOS10_dict['depth'][i0:i1][not_pad]    = gsw.z_from_p(press, lat)
+        TEOS10_dict['SA'][i0:i1][not_pad]       = SA
+        TEOS10_dict['CT'][i0:i1][not_pad]       = CT
+        TEOS10_dict['PT'][i0:i1][not_pad]       = PT
+        TEOS10_dict['sigma'][i0:i1][not_pad]    = gsw.sigma1(SA, CT)
+        TEOS10_dict['alpha'][i0:i1][not_pad]    = gsw.alpha(SA, CT, press)
+        TEOS10_dict['alpha_PT'][i0:i1][not_pad] = gsw.alpha(SA, PT, press)
+        TEOS10_dict['alpha_iT'][i0:i1][not_pad] = gsw.alpha_wrt_t_exact(SA, iT, press)
+        TEOS10_dict['beta'][i0:i1][not_pad]     = gsw.beta(SA, CT, press)
+        TEOS10_dict['beta_PT'][i0:i1][not_pad]  = gsw.beta(SA, PT, press)
+    return TEOS10_dict
+
+################################################################################
+
+def read_data_files(read_data_file, instrmt_dir, data_files, instrmt_name, n_workers=1):
+    """
+    Reads in the given data files, either one at a time or in parallel
+    Returns a list of the output dictionaries in the same order as `data_files`
+
+    read_data_file      the function with which to read one data file
+    instrmt_dir         string of a file path to this instrmt's directory
+    data_files          list of the names of the data files to read
+    instrmt_name        string of the name of this instrmt
+    n_workers           integer number of processes to use, 1 reads the files
+                            one at a time in this process
+    """
+    if n_workers > 1 and len(data_files) > 1:
+        print('Reading',len(data_files),'files with',n_workers,'workers')
+        # Send the files to the workers in batches to cut down on the overhead
+        #   of passing data between processes
+        chunksize = max(1, len(data_files)//(4*n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # `map` returns the results in the same order as the input files,
+            #   so the entry numbers come out the same as reading them serially
+            out_dicts = list(executor.map(read_data_file, repeat(instrmt_dir), data_files, repeat(instrmt_name), chunksize=chunksize))
+    else:
+        out_dicts = [read_data_file(instrmt_dir, file, instrmt_name) for file in data_files]
+    return out_dicts
 
 ################################################################################
 
@@ -574,14 +1067,10 @@ def read_ITP_data_file(file_path, file_name, instrmt):
     if 'sami' in file_name:
         print('Skipping',file_name)
         return
-    # Get just the proper file name, after the slash
-    filename2 = file_name.split('/')[-1]
-    # Assuming filename format itpXgrdYYYY.dat where YYYY is always 4 digits
-    #   works for `final` format above or `cormat` format corYYYY.mat
-    try:
-        prof_no = int(filename2[-8:-4])
-    except:
-        print('Skipping',instrmt,'file',filename2)
+    # Find the profile number from the file name
+    prof_no = find_ITP_prof_no(file_name)
+    if isinstance(prof_no, type(None)):
+        print('Skipping',instrmt,'file',file_name.split('/')[-1])
         return None
     #
     # Check to see whether loading `final` or `cormat` file format
@@ -591,6 +1080,78 @@ def read_ITP_data_file(file_path, file_name, instrmt):
         return read_ITP_final(file_path, file_name, instrmt, prof_no)
     #
 
+def find_ITP_prof_no(file_name):
+    """
+    Returns the profile number of an ITP profile file from its name, or None if
+    the name doesn't have a profile number
+
+    file_name           string of the file name of a specific file
+    """
+    # Get just the proper file name, after the slash
+    filename2 = file_name.split('/')[-1]
+    # Assuming filename format itpXgrdYYYY.dat where YYYY is always 4 digits
+    #   works for `final` format above or `cormat` format corYYYY.mat
+    try:
+        return int(filename2[-8:-4])
+    except:
+        return None
+
+# The fields of the `cormat` files which are used
+cormat_fields = ['pr_filt', 'te_adj', 'sa_adj', 'longitude', 'latitude', 'psdate', 'pedate', 'pstart', 'pstop']
+
+def find_mat_version(file_path):
+    """
+    Returns a string of the version of the MATLAB file, found from its header
+    bytes: '7.3' for HDF5-based files, '5' for v5 to v7 files, or '4' for the
+    oldest files, which have no text header
+
+    file_path           string of the file path of the .mat file
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(128)
+    # v5 and later files start with 116 bytes of descriptive text
+    if header.startswith(b'MATLAB 7.3'):
+        return '7.3'
+    elif header.startswith(b'MATLAB'):
+        return '5'
+    else:
+        return '4'
+
+def load_mat_fields(file_path, fields):
+    """
+    Returns a dictionary of just the given fields of a MATLAB file, reading
+    only those variables. Arrays of size 1 are returned as scalars, character
+    arrays as strings, and other arrays have their single dimensions removed.
+    Fields which are not in the file are left out of the dictionary
+
+    file_path           string of the file path of the .mat file
+    fields              list of strings of the names of the variables to read
+    """
+    if find_mat_version(file_path) == '7.3':
+        dat = {}
+        with h5py.File(file_path, 'r') as f:
+            for field in fields:
+                if field not in f:
+                    continue
+                this_dset = f[field]
+                # MATLAB stores arrays in column-major order, so transpose them
+                values = this_dset[()].T
+                matlab_class = this_dset.attrs.get('MATLAB_class', b'')
+                if isinstance(matlab_class, bytes):
+                    matlab_class = matlab_class.decode()
+                if matlab_class == 'char':
+                    # Characters are stored as their uint16 codes
+                    dat[field] = ''.join(map(chr, values.flatten()))
+                elif values.size == 1:
+                    dat[field] = values.item()
+                else:
+                    dat[field] = np.squeeze(values)
+                #
+            #
+        return dat
+    else:
+        return io.loadmat(file_path, variable_names=fields, squeeze_me=True, chars_as_strings=True)
+
 def read_ITP_cormat(file_path, file_name, instrmt, prof_no):
     """
     Loads the data from an ITP profile file in the `cormat` format
@@ -610,12 +1171,8 @@ def read_ITP_cormat(file_path, file_name, instrmt, prof_no):
     else:
         on_black_list = False
     #
-    # Load cormat file into dictionary with mat73
-    #   (specific to version of MATLAB used to make cormat files)
-    try:
-        dat = mat73.loadmat(file_path+'/'+file_name)
-    except:
-        dat = io.loadmat(file_path+'/'+file_name)
+    # Load just the fields needed from the cormat file into a dictionary
+    dat = load_mat_fields(file_path+'/'+file_name, cormat_fields)
     # Extract certain data from the object, specific to how the files are formatted
     #   The latitude and longitude values where the profile was taken
     lon = float(dat['longitude'])
@@ -644,21 +1201,14 @@ def read_ITP_cormat(file_path, file_name, instrmt, prof_no):
         dt_end = str(datetime.strptime(date_MMDDYY_end+' '+time_HHMMSS_end, r'%m/%d/%y %H:%M:%S'))
     except:
         dt_end = None
-    # Determine the region
-    reg = find_geo_region(lon, lat)
     #
     # If it finds the correct column headers, put data into arrays
     if 'te_adj' in dat and 'sa_adj' in dat and 'pr_filt' in dat:
         press0 = dat['pr_filt'].flatten()
         iT0  = dat['te_adj'].flatten()
         SP0  = dat['sa_adj'].flatten()
-        # Convert to absolute salinity (SA), conservative (CT) and potential temperature (PT) 
-        pf_vert_len = len(press0)
-        SA1 = gsw.SA_from_SP(SP0, press0, [lon]*pf_vert_len, [lat]*pf_vert_len)
-        CT1 = gsw.CT_from_t(SA1, iT0, press0)
-        PT1 = gsw.pt0_from_t(SA1, iT0, press0)
-        # Convert to depth from pressure
-        depth = gsw.z_from_p(press0, [lat]*pf_vert_len)
+        # Note: The TEOS-10 variables are calculated for all profiles at once
+        #   in `calc_TEOS10_vars` after the profiles have been packed together
         # Down-casts have an issue with the profiler wake, so note whether the
         #   profile was taken going up or down
         if press0[0] < press0[-1]:
@@ -672,15 +1222,10 @@ def read_ITP_cormat(file_path, file_name, instrmt, prof_no):
                     'dt_end': dt_end,
                     'lon': lon,
                     'lat': lat,
-                    'region': reg,
                     'up_cast': up_cast,
                     'press': press0,
-                    'depth': depth,
                     'iT': iT0,
-                    'CT': CT1,
-                    'PT': PT1,
-                    'SP': SP0,
-                    'SA': SA1
+                    'SP': SP0
                     }
         #
         # Return all the relevant values
@@ -707,37 +1252,28 @@ def read_ITP_final(file_path, file_name, instrmt, prof_no):
     else:
         on_black_list = False
     #
-    # Read data file in as a pandas data object
-    #   The arguments used are specific to how the ITP files are formatted
-    #   Reading in the file one line at a time because the number of items
-    #       on each line is inconsistent between files
-    dat0 = pd.read_table(file_path+'/'+file_name, header=None, nrows=2, engine='python', delim_whitespace=True).iloc[1]
-    # Extract certain data from the object, specific to how the files are formatted
+    # Read in the header and data from the file in one pass
+    dat = parse_ITP_final_file(file_path, file_name)
+    if isinstance(dat, type(None)):
+        print('Skipping',instrmt,'file',file_name)
+        return None
+    # Extract certain data from the header
     #   The date this profile was taken
     try:
-        date = str(pd.to_datetime(float(dat0[1])-1, unit='D', origin=str(dat0[0])))
+        date = str(pd.to_datetime(float(dat['day'])-1, unit='D', origin=dat['year']))
     except:
         date = None
     #   The latitude and longitude values where the profile was taken
-    lon = float(dat0[2])
-    lat = float(dat0[3])
-    # Determine the region
-    reg = find_geo_region(lon, lat)
+    lon = dat['lon']
+    lat = dat['lat']
     #
-    # Read in data from the file
-    dat = pd.read_table(file_path+'/'+file_name,header=2,skipfooter=1,engine='python',delim_whitespace=True)
     # If it finds the correct column headers, put data into arrays
-    if 'temperature(C)' and 'salinity' and '%pressure(dbar)' in dat.columns:
-        press0 = dat['%pressure(dbar)'][:].values
-        iT0  = dat['temperature(C)'][:].values
-        SP0  = dat['salinity'][:].values
-        # Convert to absolute salinity (SA), conservative (CT) and potential temperature (PT) 
-        pf_vert_len = len(press0)
-        SA1 = gsw.SA_from_SP(SP0, press0, [lon]*pf_vert_len, [lat]*pf_vert_len)
-        CT1 = gsw.CT_from_t(SA1, iT0, press0)
-        PT1 = gsw.pt0_from_t(SA1, iT0, press0)
-        # Convert to depth from pressure
-        depth = gsw.z_from_p(press0, [lat]*pf_vert_len)
+    if 'temperature(C)' in dat['columns'] and 'salinity' in dat['columns'] and '%pressure(dbar)' in dat['columns']:
+        press0 = dat['columns']['%pressure(dbar)']
+        iT0  = dat['columns']['temperature(C)']
+        SP0  = dat['columns']['salinity']
+        # Note: The TEOS-10 variables are calculated for all profiles at once
+        #   in `calc_TEOS10_vars` after the profiles have been packed together
         # `final` formatted profiles are sorted, so no way to tell which direction
         #   They were taken in. So, just mark all as up-casts
         up_cast = True
@@ -748,15 +1284,10 @@ def read_ITP_final(file_path, file_name, instrmt, prof_no):
                     'dt_end': None,
                     'lon': lon,
                     'lat': lat,
-                    'region': reg,
                     'up_cast': up_cast,
                     'press': press0,
-                    'depth': depth,
                     'iT': iT0,
-                    'CT': CT1,
-                    'PT': PT1,
-                    'SP': SP0,
-                    'SA': SA1
+                    'SP': SP0
                     }
         #
         # Return all the relevant values
@@ -764,6 +1295,72 @@ def read_ITP_final(file_path, file_name, instrmt, prof_no):
     else:
         return None
 
+def parse_ITP_final_file(file_path, file_name):
+    """
+    Reads an ITP profile file in the `final` format, opening it only once
+    Returns a dictionary with the 'year', 'day', 'lon', and 'lat' from the
+    header and a dictionary of 'columns' with an array for each column of data,
+    keyed by the column names in the file. Returns None if the file can't be read
+
+    file_path           string of a file path to the containing directory
+    file_name           string of the file name of a specific file
+    """
+    # The files are formatted like this:
+    #   %ITP 1, profile 2: year day longitude(E+) latitude(N+) ndepths
+    #   2005  227.00179  -150.1259   78.8313  1089
+    #   %pressure(dbar) temperature(C) salinity ...
+    #   ... one row of data per vertical level ...
+    #   %endofdat
+    try:
+        with open(file_path+'/'+file_name, 'r') as f:
+            # Skip the line describing the header values
+            f.readline()
+            # Read the header values
+            header = f.readline().split()
+            # Read the names of the columns
+            col_names = f.readline().split()
+            # Read the rest of the data with the C parser in numpy
+            #   The '%endofdat' line at the end gets skipped as a comment
+            data = np.loadtxt(f, comments='%', ndmin=2)
+    except (OSError, ValueError) as e:
+        print('Could not read',file_name+':',e)
+        return None
+    # Make sure the data matches the column names
+    if len(header) < 4 or data.shape[1] != len(col_names):
+        return None
+    columns = {}
+    for i in range(len(col_names)):
+        columns[col_names[i]] = data[:,i]
+    return {'year': header[0],
+            'day': header[1],
+            'lon': float(header[2]),
+            'lat': float(header[3]),
+            'columns': columns
+            }
+
+def parse_ITP_final_dir(instrmt_dir, n_workers=1):
+    """
+    Reads all the ITP profile files in the `final` format in a directory
+    Returns a dictionary of the outputs of `parse_ITP_final_file`, keyed by
+    the file names
+
+    instrmt_dir         string of a file path to this instrmt's directory
+    n_workers           integer number of processes to use, 1 reads the files
+                            one at a time in this process
+    """
+    data_files = list_data_files(instrmt_dir)
+    if isinstance(data_files, type(None)):
+        return {}
+    # Only take the gridded data files, not the 'sami' files
+    data_files = [file for file in data_files if 'grd' in file and file.endswith('.dat')]
+    if n_workers > 1 and len(data_files) > 1:
+        chunksize = max(1, len(data_files)//(4*n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            parsed = list(executor.map(parse_ITP_final_file, repeat(instrmt_dir), data_files, chunksize=chunksize))
+    else:
+        parsed = [parse_ITP_final_file(instrmt_dir, file) for file in data_files]
+    return dict(zip(data_files, parsed))
+
 ################################################################################
 
 def isfloat(num):
@@ -773,57 +1370,21 @@ def isfloat(num):
     except ValueError:
         return False
 
-def find_geo_region(lon, lat):
-    """
-    Returns a string of the geographical region of the Arctic Ocean in which
-    the coordinates are located. Region boundaries based on:
-    Peralta-Ferriz and Woodgate (2015), doi:10.1016/j.pocean.2014.12.005
-
-    lon         longitude value
-    lat         latitude value
-    """
-    if isinstance(lon, type(None)) or isinstance(lat, type(None)):
-        return 'error'
-    # Chukchi Sea
-    elif (lon > -180) & (lon < -155) & (lat > 68) & (lat < 76):
-        return 'CS'
-    # Southern Beaufort Sea
-    elif (lon > -155) & (lon < -120) & (lat > 68) & (lat < 72):
-        return 'SBS'
-    # Canada Basin
-    elif (lon > -155) & (lon < -130) & (lat > 72) & (lat < 84):
-        return 'CB'
-    # Makarov Basin part 1
-    elif (lon > 50) & (lon < 180) & (lat > 83.5) & (lat < 90):
-        return 'MB'
-    # Makarov Basin part 2
-    elif (lon > 141) & (lon < 180) & (lat > 78) & (lat < 90):
-        return 'MB'
-    # Eurasian Basin part 1
-    elif (lon > 30) & (lon < 140) & (lat > 82) & (lat < 90):
-        return 'EB'
-    # Eurasian Basin part 2
-    elif (lon > 110) & (lon < 140) & (lat > 78) & (lat < 82):
-        return 'EB'
-    # Barents Sea part 1
-    elif (lon > 15) & (lon < 60) & (lat > 75) & (lat < 80):
-        return 'BS'
-    # Barents Sea part 2
-    elif (lon > 15) & (lon < 55) & (lat > 67) & (lat < 75):
-        return 'BS'
-    else:
-        return False
-
 ################################################################################
 
-## Read instrument makes a netcdf for just the given instrument
-read_instrmt('ITP', '2', science_data_file_path+'ITPs/itp2/itp2cormat', 'netcdfs/ITP_2.nc')
-read_instrmt('ITP', '3', science_data_file_path+'ITPs/itp3/itp3cormat', 'netcdfs/ITP_3.nc')
+# Only run this part when executing the script directly, so that the worker
+#   processes which import this module to read files don't run it as well
+if __name__ == '__main__':
+    ## Read instrument makes a netcdf for just the given instrument
+    read_instrmt('ITP', '2', science_data_file_path+'ITPs/itp2/itp2cormat', 'netcdfs/ITP_2.nc')
+    read_instrmt('ITP', '3', science_data_file_path+'ITPs/itp3/itp3cormat', 'netcdfs/ITP_3.nc')
 
-## These will make all the netcdfs for a certain source (takes a long time)
-# make_all_ITP_netcdfs(science_data_file_path)
+    ## These will make all the netcdfs for a certain source (takes a long time)
+    #   Increase n_workers to read the files of each instrument in parallel
+    #   or increase n_instrmt_workers to build several instruments at once
+    # make_all_ITP_netcdfs(science_data_file_path, n_workers=4)
 
-exit(0)
+    exit(0)
 
 ## Tests for how the netcdfs turned out
 
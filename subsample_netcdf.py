@@ -4,6 +4,7 @@ Created: 2022-04-11
 
 This script is set up to subsample Arctic Ocean profile data that has been
 formatted into netcdfs by the `make_netcdf` function, adding them to those files.
+The 'Interpolate' scheme writes the interpolated profiles to a new file instead.
 
 Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
 
@@ -21,9 +22,11 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 from datetime import datetime
+# For naming the files of interpolated profiles
+import os
 
-import scipy.ndimage as ndimage
-from scipy import interpolate
+# For the encodings to use when writing netcdfs
+import data_helper_functions as dhf
 
 ################################################################################
 
@@ -35,51 +38,49 @@ ss_scheme = 'Keep every'
 n_pts = 4
 # Define the spacing (in dbar) for interpolation
 interp_spacing = 2.0
-
-################################################################################
-
-def keep_every(vert, n_pts):
-    """
-    Sub-samples one profile, keeping only every <n_pts> points, skipping the rest
-    Returns a mask which, when applied to the given vertical array, results in a
-        subsampled vertical profile. Doesn't change any of the values
-
-    vert    An array of vertical values to subsample (pressure or depth)
-    n_pts   An integer so that only every n_pts point is not masked
-    """
-    # Get the length of the vertical array
-    vert_len = len(vert)
-    # Remove all nan values from vert assuming they will only be on the end
-    vert = [x for x in vert if np.isnan(x)==False]
-    # Check to make sure there is data to use
-    if vert_len < 1:
-        return [None]*vert_len
-    else:
-        # Make a blank array in which to put the mask
-        ss_mask = np.array([None]*vert_len)
-    #
-    # Some really convenient syntax [::x] which returns a view of every x point
-    #   Not a new array, changing it will change the original
-    keep_these = ss_mask[::n_pts]
-    # Unmask every n_pts point
-    keep_these[:] = 1
-    return ss_mask
+# For the AIDJEX PDF scheme, the spacings (in the units of the original vertical
+#   measure) between the points to keep are drawn at random from the
+#   distribution of the spacings between measurements in the AIDJEX profiles,
+#   found from this netcdf (or zarr store)
+aidjex_nc = None
+# Or, if there's no AIDJEX netcdf, give the spacings and the probability of
+#   each explicitly instead, ex: [1.0, 2.0] and [0.25, 0.75]
+aidjex_spacings = None
+aidjex_probs = None
+# The seed for the random draws, so that the same mask is made every time
+ss_seed = 0
 
 ################################################################################
 # Main execution
 ################################################################################
-# Select the netcdf to modify
+# Select the netcdf to modify (or zarr store, with a path ending in .zarr)
 ncs_to_modify = [
                  # 'netcdfs/ITP_1.nc',
                  'netcdfs/ITP_2.nc',
                  # 'netcdfs/ITP_3.nc'
                  ]
 
+# Find the distribution of the spacings between the AIDJEX measurements
+if ss_scheme == 'AIDJEX PDF':
+    if not isinstance(aidjex_nc, type(None)):
+        print('Reading',aidjex_nc)
+        ds_aidjex = dhf.load_dataset(aidjex_nc)
+        aidjex_spacings, aidjex_probs = dhf.find_spacing_pdf(ds_aidjex, ds_aidjex.attrs['Original vertical measure'])
+        aidjex_source = os.path.basename(aidjex_nc)
+        del ds_aidjex
+    elif not isinstance(aidjex_spacings, type(None)):
+        aidjex_source = 'given spacings'
+    else:
+        print('Set either aidjex_nc or aidjex_spacings to use the AIDJEX PDF scheme, aborting script')
+        exit(0)
+    print('\tAIDJEX spacings:',aidjex_spacings)
+    print('\tAIDJEX probabilities:',aidjex_probs)
+
 # Loop through the netcdfs to modify
 for my_nc in ncs_to_modify:
     print('Reading',my_nc)
     # Load in with xarray
-    ds = xr.load_dataset(my_nc)
+    ds = dhf.load_dataset(my_nc)
 
     gattrs_to_print = ['Last modified', 'Last modification', 'Sub-sample scheme']
 
@@ -93,31 +94,50 @@ for my_nc in ncs_to_modify:
     # Find the original vertical variable (pressure or depth)
     vert_var = ds.attrs['Original vertical measure']
 
-    # Loop over all the profiles
-    if ss_scheme == 'AIDJEX_PDF':
-        for i in range(len(ds[vert_var].values)):
-            # Add subsample mask for this profile
-            ds['ss_mask'][i] = AIDJEX_PDF(ds[vert_var].values[i])
-    elif ss_scheme == 'Keep every':
-        for i in range(len(ds[vert_var].values)):
-            # Add subsample mask for this profile
-            ds['ss_mask'][i] = keep_every(ds[vert_var].values[i], n_pts)
-        ss_scheme += ' '+str(n_pts)+' point'
+    if ss_scheme == 'Interpolate':
+        # The interpolated profiles no longer line up with the original
+        #   measurements, so they are written to a new file
+        ds = dhf.grid_dataset(ds, interp_spacing)
+        ds['ss_mask'] = (['Time','press_level'], ds['press'].notnull().values, ds['ss_mask'].attrs)
+        this_scheme = ss_scheme+' '+str(interp_spacing)+' dbar'
+        out_file = os.path.splitext(my_nc)[0]+'_interp'+os.path.splitext(my_nc)[1]
+    else:
+        # Make the subsample mask for all the profiles at once
+        vert_arr = dhf.get_profile_array(ds, vert_var)
+        if ss_scheme == 'AIDJEX PDF':
+            ss_arr = dhf.ss_spacing_pdf(vert_arr, aidjex_spacings, aidjex_probs, ss_seed)
+            this_scheme = ss_scheme+' from '+aidjex_source
+        elif ss_scheme == 'Keep every':
+            ss_arr = dhf.ss_keep_every(vert_arr, n_pts)
+            this_scheme = ss_scheme+' '+str(n_pts)+' point'
+        else:
+            print('Sub-sample scheme',ss_scheme,'not recognized, aborting script')
+            exit(0)
+        if dhf.is_ragged(ds):
+            # Take the mask back out of the padded array
+            pf_ids, vert_idx = dhf.get_obs_position(ds['row_size'].values)
+            ds['ss_mask'] = (['obs'], ss_arr[pf_ids, vert_idx], ds['ss_mask'].attrs)
+        else:
+            ds['ss_mask'] = (['Time',dhf.get_vert_dim(ds)], ss_arr, ds['ss_mask'].attrs)
+        out_file = my_nc
     # print('ss_mask:',ds['ss_mask'].values)
 
     # Update the global variables:
     ds.attrs['Last modified'] = str(datetime.now())
     ds.attrs['Last modification'] = 'Modified sub-sample scheme'
-    ds.attrs['Sub-sample scheme'] = ss_scheme
+    ds.attrs['Sub-sample scheme'] = this_scheme
 
-    # Write out to netcdf
-    print('Writing data to',my_nc)
-    ds.to_netcdf(my_nc, 'w')
+    # Write out to netcdf, or just the changed variables to a zarr store
+    print('Writing data to',out_file)
+    if out_file == my_nc:
+        dhf.update_dataset_vars(ds, out_file, ['ss_mask'])
+    else:
+        dhf.write_dataset(ds, out_file)
 
     # Load in with xarray
-    ds2 = xr.load_dataset(my_nc)
+    ds2 = dhf.load_dataset(out_file)
 
     for attr in gattrs_to_print:
         print('\t',attr+':',ds2.attrs[attr])
     print('\t ss_mask:')
-    print('\t',ds2.where(ds2.prof_no==7, drop=True).squeeze().ss_mask.values)
+    print('\t',dhf.select_profiles(ds2, dhf.find_profile_index(ds2, [7]))['ss_mask'].values)
@@ -5,6 +5,7 @@ Created: 2022-06-17
 This script is set up to take the moving average of Arctic Ocean profile data
 that has been formatted into netcdfs by the `make_netcdf` function, adding
 the variables 'ma_iT', 'ma_CT', 'ma_SP', 'ma_SA', and 'ma_sigma' to those files.
+The moving averages for several windows are stored along the `ell` dimension.
 
 Redistribution and use in source and binary forms, with or without modification, are permitted provided that the following conditions are met:
 
@@ -29,18 +30,60 @@ from scipy import interpolate
 # Import the Thermodynamic Equation of Seawater 2010 (TEOS-10) from GSW
 # For calculating density anomaly
 import gsw
-
-# The moving average window in dbar
-m_avg_win = 25
-# Vertical resolution of the data
-res = 0.25
-# The number of data points across which to average
-c3 = int(m_avg_win/res)
+# For the encodings to use when writing netcdfs
+import data_helper_functions as dhf
+
+# The moving average windows in dbar, all stored along the `ell` dimension
+#   The first is the default, used when no window is given in the profile filters
+m_avg_wins = [25, 2.5, 12.5, 37.5]
+# The number of profiles to take the moving averages of at a time, each chunk
+#   being written back into the file in place before the next is read, so that
+#   only one chunk is ever held in memory. None to load each whole file at once,
+#   which is needed to change the windows stored along `ell`
+pfs_per_chunk = None
+
+# The variables to take the moving averages of
+ma_vars = ['iT','CT','PT','SP','SA']
+
+def find_m_avgs(ds, m_avg_wins, res):
+    """
+    Returns an xarray dataset of the moving averages of the variables in
+    `ma_vars`, and the density found from them, for each of the given windows
+    along `ell`. The averages are taken separately for each profile
+
+    ds                  An xarray dataset, padded, gridded, or ragged
+    m_avg_wins          A list of the moving average windows in dbar
+    res                 The vertical resolution of the data in dbar
+    """
+    # The number of data points across which to average for each window
+    list_of_c3 = [int(m_avg_win/res) for m_avg_win in m_avg_wins]
+    if dhf.is_ragged(ds):
+        # Average over each profile's run of observations along `obs` separately
+        ma_arrs = dhf.ragged_boxcar_averages(np.stack([ds[var].values for var in ma_vars]), ds['row_size'].values, list_of_c3)
+        ma_dims = ['ell', 'obs']
+    else:
+        # For padded or gridded data, each profile is one run of the flattened
+        #   arrays, and the NaN padding at the end of each profile is masked
+        #   like its edges
+        vert_dim = dhf.get_vert_dim(ds)
+        arrs = np.stack([ds[var].transpose('Time',vert_dim).values for var in ma_vars])
+        row_size = np.full(ds.sizes['Time'], ds.sizes[vert_dim])
+        ma_arrs = dhf.ragged_boxcar_averages(arrs.reshape(len(ma_vars), -1), row_size, list_of_c3).reshape((len(m_avg_wins),)+arrs.shape)
+        ma_dims = ['ell', 'Time', vert_dim]
+    ds_ma = xr.Dataset(coords={'ell':('ell', m_avg_wins, {
+                            'units':'dbar',
+                            'label':r'$\ell$ (dbar)',
+                            'long_name':'Moving average window'
+                        })})
+    for i in range(len(ma_vars)):
+        ds_ma['ma_'+ma_vars[i]] = (ma_dims, ma_arrs[:,i], ds['ma_'+ma_vars[i]].attrs)
+    ds_ma['ma_sigma'] = (ma_dims, gsw.sigma1(ds_ma['ma_SP'].values, ds_ma['ma_CT'].values), ds['ma_sigma'].attrs)
+    return ds_ma
 
 ################################################################################
 # Main execution
 ################################################################################
-# Select the netcdfs to modify
+# Select the netcdfs to modify (or zarr stores, with paths ending in .zarr)
 ncs_to_modify = [
                  'netcdfs/ITP_2.nc',
                  'netcdfs/ITP_3.nc'
@@ -50,8 +93,12 @@ ncs_to_modify = [
 for my_nc in ncs_to_modify:
     print('')
     print('Reading',my_nc)
-    # Load in with xarray
-    ds = xr.load_dataset(my_nc)
+    if isinstance(pfs_per_chunk, type(None)):
+        # Load in with xarray
+        ds = dhf.load_dataset(my_nc)
+    else:
+        # Open lazily, so only the per-profile variables are read for now
+        ds = dhf.open_dataset(my_nc)
 
     gattrs_to_print = ['Last modified', 'Last modification', 'Moving average window']
 
@@ -62,38 +109,73 @@ for my_nc in ncs_to_modify:
     print('making changes')
 
     ## Get the moving average profiles
-    # Convert a subset of the dataset to a dataframe
-    df = ds[['press','iT','CT','PT','SP','SA']].squeeze().to_dataframe()
-    # Get the original dimensions of the data to reshape the arrays later
-    len0 = len(df.index.get_level_values(0).unique())
-    len1 = len(df.index.get_level_values(1).unique())
-    # Use the pandas `rolling` function to get the moving average
-    #   center=True makes the first and last window/2 of the profiles are masked
-    #   win_type='boxcar' uses a rectangular window shape
-    #   on='press' means it will take `press` as the index column
-    #   .mean() takes the average of the rolling
-    #   multiplying m_avg_win by 4 because the data is in 0.25 dbar increments
-    df1 = df.rolling(window=int(c3), center=True, win_type='boxcar', on='press').mean()
-    # Put the moving average profiles for temperature, salinity, and density into the dataset
-    ds['ma_iT'].values = df1['iT'].values.reshape((len0, len1))
-    ds['ma_CT'].values = df1['CT'].values.reshape((len0, len1))
-    ds['ma_PT'].values = df1['PT'].values.reshape((len0, len1))
-    ds['ma_SP'].values = df1['SP'].values.reshape((len0, len1))
-    ds['ma_SA'].values = df1['SA'].values.reshape((len0, len1))
-    ds['ma_sigma'].values= gsw.sigma1(ds['ma_SP'], ds['ma_CT'])
+    n_pfs = ds.sizes['Time']
+    # Find the vertical resolution of the data (the grid spacing, if gridded),
+    #   just from the first chunk of profiles when streaming
+    if isinstance(pfs_per_chunk, type(None)):
+        res = dhf.get_vert_res(ds)
+    else:
+        res = dhf.get_vert_res(dhf.select_profiles(ds, np.arange(min(pfs_per_chunk, n_pfs))))
+
+    # Find which windows can be written
+    if isinstance(pfs_per_chunk, type(None)):
+        these_wins = m_avg_wins
+    else:
+        # The moving averages can only be written in place into variables which
+        #   already have the same windows along `ell`, or just the default
+        #   window into variables without `ell`
+        if 'ell' not in ds['ma_CT'].dims:
+            these_wins = m_avg_wins[:1]
+            print('\tNo `ell` dimension in',my_nc,'so only writing the',m_avg_wins[0],'dbar window')
+            print('\tSet pfs_per_chunk to None to add all the windows along `ell`')
+        elif list(ds['ell'].values) == m_avg_wins:
+            these_wins = m_avg_wins
+        else:
+            print('\tWindows stored in',my_nc,'are',list(ds['ell'].values),'not',m_avg_wins)
+            print('\tSet pfs_per_chunk to None to replace them, aborting script')
+            exit(0)
+    print('\tAveraging across',[int(m_avg_win/res) for m_avg_win in these_wins],'points at',res,'dbar resolution')
 
     # Update the global variables:
     ds.attrs['Last modified'] = str(datetime.now())
-    ds.attrs['Last modification'] = 'Added moving averages with '+str(m_avg_win)+' dbar window'
-    ds.attrs['Moving average window'] = str(m_avg_win)+' dbar'
-
-    # Write out to netcdf
-    print('Writing data to',my_nc)
-    ds.to_netcdf(my_nc, 'w')
-
-    # Load in with xarray
-    ds2 = xr.load_dataset(my_nc)
+    ds.attrs['Last modification'] = 'Added moving averages with '+str(these_wins)+' dbar windows'
+    ds.attrs['Moving average window'] = str(these_wins[0])+' dbar'
+
+    if isinstance(pfs_per_chunk, type(None)):
+        # Replace the moving averages with those of all the windows along `ell`
+        ds_ma = find_m_avgs(ds, these_wins, res)
+        ds = ds.drop_vars(list(ds_ma.data_vars)+['ell'], errors='ignore')
+        ds = ds.assign_coords(ell=ds_ma['ell'])
+        for var in ds_ma.data_vars:
+            ds[var] = ds_ma[var]
+        # Write out to netcdf, or just the changed variables to a zarr store
+        print('Writing data to',my_nc)
+        dhf.update_dataset_vars(ds, my_nc, list(ds_ma.data_vars))
+    else:
+        if dhf.is_ragged(ds):
+            # The index along `obs` of the first observation of each profile
+            obs_starts = np.append(0, np.cumsum(ds['row_size'].values))
+        print('Writing data to',my_nc,'in chunks of',pfs_per_chunk,'profiles')
+        # Close the file so it can be opened to write into
+        ds.close()
+        for i0 in range(0, n_pfs, pfs_per_chunk):
+            i1 = min(i0+pfs_per_chunk, n_pfs)
+            # Read in just the variables to average for this chunk of profiles,
+            #   closing the file again before writing into it
+            with dhf.open_dataset(my_nc) as ds_in:
+                ds_chunk = dhf.select_profiles(ds_in, np.arange(i0, i1))
+                for var in ma_vars:
+                    ds_chunk[var] = ds_chunk[var].load()
+                ds_ma = find_m_avgs(ds_chunk, these_wins, res)
+            if 'ell' not in ds['ma_CT'].dims:
+                ds_ma = ds_ma.isel(ell=0, drop=True)
+            if dhf.is_ragged(ds):
+                dhf.write_vars_region(ds_ma, my_nc, {'obs':slice(obs_starts[i0], obs_starts[i1])})
+            else:
+                dhf.write_vars_region(ds_ma, my_nc, {'Time':slice(i0, i1)})
+            #
+        dhf.update_dataset_attrs(my_nc, ds.attrs)
 
     # See the variables after
     for attr in gattrs_to_print:
-        print('\t',attr+':',ds2.attrs[attr])
+        print('\t',attr+':',ds.attrs[attr])